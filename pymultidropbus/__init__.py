@@ -1,6 +1,7 @@
 import logging
 import termios
 import threading
+import time
 from collections import deque
 from queue import Queue
 from struct import pack
@@ -9,9 +10,13 @@ import os
 import serial
 
 import pymultidropbus.helpers
+import pymultidropbus.transfer as transfer
 import pymultidropbus.protocol as protocol
 import pymultidropbus.protocol.peripherals.Cashless as Cashless
 from pymultidropbus.protocol import Vmc
+from pymultidropbus.metrics import MetricsRegistry, MetricsServer
+from pymultidropbus.dispatch import EventDispatcher
+from pymultidropbus.journal import Durability, RecordType, SessionJournal, UnfinishedVend
 
 CMSPAR = 0x40000000
 
@@ -19,6 +24,9 @@ SEND_POLL_COMMANDS = False  # be careful, there's A LOT of these and the library
 SEND_CC_COMMANDS = False
 SEND_BV_COMMANDS = False
 
+# errors raised by pyserial/termios when the serial device disappears (e.g. a USB-serial adapter resetting)
+SERIAL_ERRORS = (serial.SerialException, OSError, termios.error)
+
 logging.basicConfig()
 logger = logging.getLogger("pymultidropbus")
 
@@ -47,38 +55,158 @@ class IncomingCommandThread(threading.Thread):
     def stopped(self):
         return self._stop_event.is_set()
 
+    def wait(self, timeout: float) -> bool:
+        # sleeps for up to timeout seconds, returning early (and True) if the thread is stopped
+        return self._stop_event.wait(timeout)
+
     def run(self):
         while self._stop_event.is_set() is False:
-            self.mdb.check_for_command()
+            try:
+                self.mdb.check_for_command()
+            except SERIAL_ERRORS as e:
+                if self.stopped():
+                    break
+                self.logger.warning(f"Lost connection to the serial port: {e}")
+                self.mdb.metric_disconnects.inc()
+                self.mdb.reconnect()
 
 
 class Peripheral:
     def __init__(self,
-                 event_queue: "Queue[protocol.MdbCommandEvent]",
+                 event_queue: "Queue[protocol.MdbCommandEvent] or None",
                  com_port: str = "/dev/ttyAMA0",
                  baudrate: str = 9600,
                  enable_unsupported_commands: bool = False,
                  enable_default_responses: bool = True,
                  log_level=logging.DEBUG,
                  report_acks: bool = False,
-                 process_affinity=None):
+                 process_affinity=None,
+                 auto_open: bool = True,
+                 reconnect_min_delay: float = 0.005,
+                 reconnect_max_delay: float = 0.5,
+                 metrics: MetricsRegistry = None,
+                 dispatcher: EventDispatcher = None,
+                 capture=None):
         logger.setLevel(log_level)
         self.mdb_send_queue = Queue()  # we use this to queue up commands that have to wait for a poll command
         self.event_queue = event_queue  # we publish events to this queue to be consumed outside this library
+        self.dispatcher = dispatcher  # and/or dispatch them to handlers that subscribed to specific commands
         self.enable_unsupported_commands = enable_unsupported_commands  # publish unsupported/unknown commands
         self.enable_default_responses = enable_default_responses  # send default responses to commands like ACKs etc.
         self.report_acks = report_acks  # report ACKs to the event queue
+        self.com_port = com_port
+        self.baudrate = baudrate
+        self.process_affinity = process_affinity
+        self.reconnect_min_delay = reconnect_min_delay  # reconnect backoff starts here and doubles on each attempt
+        self.reconnect_max_delay = reconnect_max_delay  # up to this many seconds between attempts
+        self.serial_port = None
+        self.mode_bit_enabled = False
+        self.capture = capture  # optional text file every frame is logged to, in the format analytics reads
+
+        # Counters and gauges that are cheap enough to update inline on the bus thread. They're labelled with the
+        # port, so several peripherals can share one registry.
+        self.metrics = metrics if metrics is not None else MetricsRegistry()
+        self.metric_labels = {"port": com_port}
+        labels = self.metric_labels
+        self.metric_frames = self.metrics.counter("frames", "Frames received from the VMC.", labels)
+        self.metric_corrupt_frames = self.metrics.counter(
+            "corrupt_frames", "Frames discarded because they timed out before a valid checksum.", labels)
+        self.metric_oversized_frames = self.metrics.counter(
+            "oversized_frames", "Frames discarded because they were longer than 36 bytes.", labels)
+        self.metric_ret = self.metrics.counter("ret", "RET (retransmit) commands received from the VMC.", labels)
+        self.metric_nak = self.metrics.counter("nak", "NAK commands received from the VMC.", labels)
+        self.metric_disconnects = self.metrics.counter("disconnects", "Times the serial device disappeared.", labels)
+        self.metrics.gauge("send_queue_depth", "Responses waiting for a POLL.", labels,
+                           function=self.mdb_send_queue.qsize)
+        self.metrics.gauge("event_queue_depth", "Events waiting to be consumed.", labels,
+                           function=lambda: self.event_queue.qsize() if self.event_queue is not None else 0)
+        if self.dispatcher is not None:
+            self.metrics.gauge("dispatch_backlog", "Events waiting for a dispatcher worker.", labels,
+                               function=self.dispatcher.backlog)
+            self.metrics.gauge("dispatch_priority_backlog", "Priority events waiting for a dispatcher worker.", labels,
+                               function=self.dispatcher.priority_backlog)
+
+        # This handles incoming commands from the MDB bus
+        self.incoming_command_thread = None
+
+        if auto_open:
+            self.open()
+
+    @property
+    def is_open(self) -> bool:
+        return self.serial_port is not None and self.serial_port.is_open
+
+    def open(self):
+        """Opens the serial port and starts processing commands from the MDB bus."""
+        if self.incoming_command_thread is not None:
+            return
+
+        if self.dispatcher is not None:
+            self.dispatcher.start()
+        self._open_serial_port()
+        self.incoming_command_thread = IncomingCommandThread(self, process_affinity=self.process_affinity)
+        self.incoming_command_thread.start()
+
+    def close(self):
+        """Stops processing commands from the MDB bus and closes the serial port."""
+        thread = self.incoming_command_thread
+        if thread is not None:
+            thread.stop()
+            if thread is not threading.current_thread():
+                thread.join()
+            self.incoming_command_thread = None
+
+        self._close_serial_port()
+        if self.dispatcher is not None:
+            self.dispatcher.stop()
+
+    def reconnect(self):
+        # Called from the incoming command thread when the serial device disappears. We keep retrying with a bounded
+        # exponential backoff until the device comes back. Everything else (reader state, session balance, queued poll
+        # responses) lives on this object and is untouched, so we can answer POLLs again as soon as the port reopens.
+        disconnected_at = time.monotonic()
+        self._close_serial_port()
+
+        delay = self.reconnect_min_delay
+        while not self._stopping():
+            try:
+                self._open_serial_port()
+            except SERIAL_ERRORS as e:
+                logger.debug(f"Reconnect to {self.com_port} failed, retrying in {delay * 1000:.0f}ms: {e}")
+                self._close_serial_port()
+                self.incoming_command_thread.wait(delay)
+                delay = min(delay * 2, self.reconnect_max_delay)
+                continue
+
+            logger.warning(f"Reconnected to {self.com_port} after "
+                           f"{(time.monotonic() - disconnected_at) * 1000:.1f}ms")
+            self._on_reconnected()
+            return
+
+    def _on_reconnected(self):
+        # hook for subclasses to restore any device specific state after a reconnect
+        pass
+
+    def _stopping(self) -> bool:
+        return self.incoming_command_thread is None or self.incoming_command_thread.stopped()
+
+    def _open_serial_port(self):
         self.serial_port = serial.Serial(
-            com_port, baudrate, 8, serial.PARITY_SPACE, timeout=0.01
+            self.com_port, self.baudrate, 8, serial.PARITY_SPACE, timeout=0.01
         )
         logger.info("Connected to: " + self.serial_port.name)
-        self.serial_port.reset_input_buffer()
+        self.serial_port.reset_input_buffer()  # throw away any partial frames from before we (re)connected
         self.mode_bit_enabled = False
         self._mode_bit_enable_mark()
 
-        # This handles incoming commands from the MDB bus
-        self.incoming_command_thread = IncomingCommandThread(self, process_affinity=process_affinity)
-        self.incoming_command_thread.start()
+    def _close_serial_port(self):
+        if self.serial_port is None:
+            return
+        try:
+            self.serial_port.close()
+        except SERIAL_ERRORS:
+            pass  # the device has probably already gone away
+        self.serial_port = None
 
     def _mode_bit_enable_mark(self):
         # logger.debug("Enabling mark parity")
@@ -108,6 +236,8 @@ class Peripheral:
             logger.debug("Sending ACK")
         self.serial_port.write(bytearray.fromhex("00"))
         self._mode_bit_off()
+        if self.capture is not None:
+            self._capture("<", "00")
 
     def _send_just_reset(self):
         logger.debug("Sending just reset")
@@ -130,6 +260,29 @@ class Peripheral:
         helpers.wait_for_output_buffer_to_clear(command_chk_byte)
         logger.debug("Wrote cmd: " + command_string + " {:02X}".format(check_byte))
         self._mode_bit_off()
+        if self.capture is not None:
+            self._capture("<", command_string)
+
+    def _capture(self, direction: str, frame: str):
+        # "<timestamp> <direction> <hex>", see pymultidropbus.analytics
+        try:
+            self.capture.write(f"{time.time():.6f} {direction} {frame.upper()}\n")
+        except (OSError, ValueError) as e:
+            logger.warning(f"Failed to write to the capture log, disabling it: {e}")
+            self.capture = None
+
+    def _wants(self, command, report: bool = True) -> bool:
+        # Checked before creating an event, so events nobody is listening for are never allocated. The event queue
+        # gets every event its report flag allows, while dispatcher handlers opt in by subscribing.
+        if report and self.event_queue is not None:
+            return True
+        return self.dispatcher is not None and self.dispatcher.wants(command)
+
+    def _publish(self, event: protocol.MdbCommandEvent, report: bool = True):
+        if report and self.event_queue is not None:
+            self.event_queue.put(event)
+        if self.dispatcher is not None:
+            self.dispatcher.publish(event)
 
     def _queue_poll_response(self, command_string: str):
         queued_response = {
@@ -137,6 +290,13 @@ class Peripheral:
         }
         self.mdb_send_queue.put(queued_response)
 
+    def _requeue_poll_response(self, queued_response: dict):
+        # puts a response we failed to send back at the front of the queue, so it's the first thing sent after we
+        # reconnect. The queue's unfinished task count was never decremented for it so we leave that alone.
+        with self.mdb_send_queue.mutex:
+            self.mdb_send_queue.queue.appendleft(queued_response)
+            self.mdb_send_queue.not_empty.notify()
+
     def process_cmd(self, command):
         raise NotImplementedError("You must implement this method in a subclass")
 
@@ -146,10 +306,14 @@ class Peripheral:
         # Keep reading through bytes until we get the start of a packet. The start of a packet is always an address byte
         # with the 9th bit set, which shows as a parity error, which Linux marks by prepending 0xFF 0x00 to the byte.
         while "".join(start_bytes) != "FF00":
+            if self._stopping():
+                return
             try:
                 new_byte = self.serial_port.read(size=1).hex().upper()
                 if new_byte:
                     start_bytes.append(new_byte)
+            except SERIAL_ERRORS:
+                raise  # let the incoming command thread reconnect instead of spinning here forever
             except Exception:
                 continue
 
@@ -157,6 +321,13 @@ class Peripheral:
 
         # return straight away, these special packets don't have a checksum
         if command in ["00", "AA", "FF"]:
+            self.metric_frames.inc()
+            if command == protocol.MdbCommand.RET:
+                self.metric_ret.inc()
+            elif command == protocol.MdbCommand.NAK:
+                self.metric_nak.inc()
+            if self.capture is not None:
+                self._capture(">", command)
             self.process_cmd(command)
             return
 
@@ -169,6 +340,7 @@ class Peripheral:
 
             if len(command) > 36 * 2:  # * 2 because we're working with hex strings (e.g. FF)
                 logger.warning("Command too long, discarding: " + command)
+                self.metric_oversized_frames.inc()
                 return
 
             # keep reading individual bytes until we get the checksum
@@ -178,6 +350,9 @@ class Peripheral:
             if new_byte:
                 # if the new byte is the checksum, we've got all the bytes so process the command
                 if helpers.hex_to_int(new_byte) == full_command_checksum:
+                    self.metric_frames.inc()
+                    if self.capture is not None:
+                        self._capture(">", command)
                     self.process_cmd(command)
                     return
                 else:
@@ -189,42 +364,164 @@ class Peripheral:
                 if command:
                     logger.debug(f"Command: {command} New Byte: {new_byte} Checksum: {full_command_checksum}")
                     logger.debug("Corrupt command, discarding: " + command)
+                    self.metric_corrupt_frames.inc()
                 return
 
 
 class CashlessPeripheral(Peripheral):
     def __init__(self,
-                 event_queue: "Queue[protocol.MdbCommandEvent]",
+                 event_queue: "Queue[protocol.MdbCommandEvent] or None",
                  com_port: str = "/dev/ttyAMA0",
                  baudrate: str = 9600,
                  enable_unsupported_commands: bool = False,
                  enable_default_responses: bool = True,
                  log_level=logging.DEBUG,
                  report_acks: bool = False,
-                 process_affinity=None):
+                 process_affinity=None,
+                 auto_open: bool = True,
+                 reconnect_min_delay: float = 0.005,
+                 reconnect_max_delay: float = 0.5,
+                 metrics: MetricsRegistry = None,
+                 journal: SessionJournal = None,
+                 dispatcher: EventDispatcher = None,
+                 ftl_window: int = 4,
+                 ftl_timeout: float = 30.0,
+                 capture=None):
         super().__init__(event_queue, com_port, baudrate, enable_unsupported_commands, enable_default_responses,
-                         log_level, report_acks, process_affinity)
+                         log_level, report_acks, process_affinity, auto_open=False,
+                         reconnect_min_delay=reconnect_min_delay, reconnect_max_delay=reconnect_max_delay,
+                         metrics=metrics, dispatcher=dispatcher, capture=capture)
+        # The reader state is changed from the bus thread and from application threads (e.g. deny_vend), so the time
+        # spent in each state is kept under a lock and read by the counters when the registry is collected.
+        self._reader_state_lock = threading.Lock()
+        self._state_seconds = {state: 0.0 for state in Cashless.State}
+        self._reader_state_changed_at = time.monotonic()
+        self.metric_state_seconds = {
+            state: self.metrics.counter("cashless_state_seconds", "Time spent in each cashless reader state.",
+                                        {**self.metric_labels, "state": state.name},
+                                        function=lambda state=state: self.seconds_in_state(state))
+            for state in Cashless.State
+        }
         self.reader_state: Cashless.State = Cashless.State.INACTIVE
         self.session_balance: protocol.Money or None = None
+        self.journal = journal  # optional write-ahead journal of session lifecycle records
+        self.unfinished_vends: "list[UnfinishedVend]" = []  # vends from a previous run that never finished
+
+        # expansion user files and FTL (file transport layer) block transfers
+        # file number -> data served to EXPANSION READ USER FILE, at most transfer.MAX_USER_FILE_SIZE bytes each
+        self.user_files: "dict[int, bytes]" = {}
+        self.ftl_files: "dict[int, bytes]" = {}  # file id -> data served when the VMC sends FTL REQ TO RCV
+        self.ftl_window = ftl_window  # how many SEND BLOCK responses to build ahead of the POLLs that send them
+        self.ftl_timeout = ftl_timeout  # seconds a transfer can go without progress before it's abandoned
+        self.outgoing_transfer: transfer.OutgoingTransfer or None = None
+        self.incoming_transfer: transfer.IncomingTransfer or None = None
+        self._ftl_blocks = deque()  # (command, data bytes) ready to send on the next POLLs
+        self.metric_ftl_bytes_sent = self.metrics.counter("ftl_bytes_sent", "File data bytes sent to the VMC.",
+                                                          self.metric_labels)
+        self.metric_ftl_bytes_received = self.metrics.counter(
+            "ftl_bytes_received", "File data bytes received from the VMC.", self.metric_labels)
+
+        # don't start processing commands until our own state is set up
+        if auto_open:
+            self.open()
+
+    @property
+    def reader_state(self) -> Cashless.State:
+        return self._reader_state
+
+    @reader_state.setter
+    def reader_state(self, state: Cashless.State):
+        # account the time spent in the previous state whenever we transition
+        with self._reader_state_lock:
+            now = time.monotonic()
+            previous_state = getattr(self, "_reader_state", None)
+            if previous_state is not None:
+                self._state_seconds[previous_state] += now - self._reader_state_changed_at
+            self._reader_state = state
+            self._reader_state_changed_at = now
+
+    def seconds_in_state(self, state: Cashless.State) -> float:
+        """Total time spent in a reader state, including the time so far if it's the current state."""
+        with self._reader_state_lock:
+            seconds = self._state_seconds[state]
+            if getattr(self, "_reader_state", None) == state:
+                seconds += time.monotonic() - self._reader_state_changed_at
+            return seconds
+
+    def open(self):
+        if self.journal is not None and not self.journal.is_open:
+            self._recover_from_journal()
+        super().open()
+
+    def close(self):
+        super().close()
+        if self.journal is not None:
+            self.journal.close()
+
+    def _recover_from_journal(self):
+        recovery = self.journal.open()
+        self.unfinished_vends = list(recovery.unfinished_vends)
+
+        # The reader state isn't restored because we must announce JUST RESET to the VMC after a restart, but the
+        # balance of a session that was still open is.
+        if recovery.session_open and recovery.session_balance_cents is not None:
+            self.session_balance = protocol.Money(recovery.session_balance_cents)
+
+        for vend in self.unfinished_vends:
+            logger.warning(f"Unfinished vend from a previous run. Session: {vend.session} Vend: {vend.vend} "
+                           f"Price: {vend.item_price_cents} cents Approved: {vend.approved} "
+                           f"Charged: {vend.amount_charged_cents} cents")
+
+    def reconcile_vend(self, vend: UnfinishedVend) -> None:
+        """Marks an unfinished vend from a previous run as dealt with (e.g. refunded or confirmed)."""
+        self.journal.reconcile(vend)
+        self.unfinished_vends.remove(vend)
+
+    def _journal_record(self, record_type: RecordType, wait: bool = False, **fields) -> bool:
+        if self.journal is None:
+            return True
+        return self.journal.record(record_type, wait=wait, state=self.reader_state.name, **fields)
+
+    def _on_reconnected(self):
+        logger.info(f"Restored reader state: {self.reader_state.name} Session balance: {self.session_balance} "
+                    f"Queued responses: {self.mdb_send_queue.qsize()}")
 
     def deny_vend(self) -> None:
         self._queue_poll_response(Cashless.MdbResponse.DENY_VEND.build())
         self.reader_state = Cashless.State.IDLE
+        self._journal_record(RecordType.DENY_VEND)
+
+    def approve_vend(self, amount_charged_in_cents: int) -> bool:
+        if self.reader_state != Cashless.State.VEND:
+            # e.g. the VMC cancelled the vend before our handler got to it
+            logger.warning("No vend in progress, cannot approve vend")
+            return False
 
-    def approve_vend(self, amount_charged_in_cents: int) -> None:
         money = protocol.Money(amount_charged_in_cents)
         command = Cashless.MdbResponse.APPROVE_VEND.build(money)
+        # The VMC mustn't hear about the approval before it's durable, or a crash could replay a vend we charged for
+        # as never approved. This runs on the application's thread, not the POLL path, so it can wait for the commit.
+        if not self._journal_record(RecordType.APPROVE_VEND, wait=True, amount=money.cents):
+            logger.error("Couldn't journal the vend approval, denying the vend instead")
+            self.deny_vend()
+            return False
+        if self.reader_state != Cashless.State.VEND:
+            logger.warning("The vend was cancelled while the approval was being journaled, not approving it")
+            return False
+
         logger.info("Approving vend and sending: " + command)
         self._queue_poll_response(command)
+        return True
 
     def start_cashless_session(self, available_balance_in_cents: int = None) -> bool:
         if self.reader_state == Cashless.State.ENABLED:
             logger.info("Queueing start cashless session")
-            self.session_balance = protocol.UNKNOWN_MONEY_VALUE  # defaults to unknown
+            self.session_balance = protocol.Money(protocol.MAX_MONEY_VALUE)  # defaults to unknown (FFFF)
             if available_balance_in_cents:
                 self.session_balance = protocol.Money(available_balance_in_cents)
 
             command = Cashless.MdbResponse.BEGIN_SESSION.build(self.session_balance)
+            self._journal_record(RecordType.BEGIN_SESSION, balance=self.session_balance.cents)
             self._queue_poll_response(command)
             return True
         else:
@@ -237,6 +534,103 @@ class CashlessPeripheral(Peripheral):
     def cancelled(self):
         self._queue_poll_response(Cashless.MdbResponse.CANCELLED.build())
 
+    def send_file(self, file_id: int, payload: bytes,
+                  destination: int = transfer.VMC_ADDRESS) -> "transfer.OutgoingTransfer or None":
+        """Asks the VMC to accept a file, which is then sent in maximal size blocks as it POLLs us."""
+        if self.outgoing_transfer is not None:
+            logger.warning("A file is already being sent, cannot send another")
+            return None
+
+        source = transfer.CASHLESS_ADDRESSES[Cashless.CashlessDeviceAddress.PRIMARY]
+        self.outgoing_transfer = transfer.OutgoingTransfer(file_id, payload, destination, source)
+        logger.info(f"Queueing FTL REQ TO SEND for file {file_id} ({len(payload)} bytes)")
+        self._queue_poll_response(Cashless.MdbResponse.REQ_TO_SEND.build(
+            destination, source, file_id, self.outgoing_transfer.block_count))
+        return self.outgoing_transfer
+
+    def request_file(self, file_id: int, source: int = transfer.VMC_ADDRESS,
+                     max_blocks: int = transfer.MAX_BLOCKS) -> "transfer.IncomingTransfer or None":
+        """Asks the VMC to send us a file of at most max_blocks blocks. It arrives as a FileReceivedCommandEvent."""
+        if self.incoming_transfer is not None:
+            logger.warning("A file is already being received, cannot request another")
+            return None
+
+        destination = transfer.CASHLESS_ADDRESSES[Cashless.CashlessDeviceAddress.PRIMARY]
+        self.incoming_transfer = transfer.IncomingTransfer(file_id, max_blocks, destination, source, size_known=False)
+        logger.info(f"Queueing FTL REQ TO RCV for file {file_id}")
+        self._queue_poll_response(Cashless.MdbResponse.REQ_TO_RECV.build(source, destination, file_id, max_blocks))
+        return self.incoming_transfer
+
+    def cancel_transfers(self, reason: str = "cancelled"):
+        """Abandons any file transfers in progress, e.g. if the VMC has stopped responding to them."""
+        self._abandon_outgoing_transfer(reason)
+        self._abandon_incoming_transfer(reason)
+
+    def _expire_transfers(self):
+        outgoing = self.outgoing_transfer
+        if outgoing is not None and outgoing.idle_seconds() > self.ftl_timeout:
+            self._abandon_outgoing_transfer(f"no progress for {self.ftl_timeout}s")
+        incoming = self.incoming_transfer
+        if incoming is not None and incoming.idle_seconds() > self.ftl_timeout:
+            # this is also how a requested file of unknown size that never sends a short last block ends up
+            self._abandon_incoming_transfer(f"no progress for {self.ftl_timeout}s")
+
+    def _abandon_outgoing_transfer(self, reason: str):
+        outgoing = self.outgoing_transfer
+        self._cancel_outgoing_transfer()
+        if outgoing is not None:
+            self._transfer_failed(outgoing, Cashless.FileTransferDirection.SEND, reason)
+
+    def _abandon_incoming_transfer(self, reason: str):
+        incoming = self.incoming_transfer
+        self.incoming_transfer = None
+        if incoming is not None:
+            self._transfer_failed(incoming, Cashless.FileTransferDirection.RECEIVE, reason)
+
+    def _transfer_failed(self, failed: "transfer.OutgoingTransfer or transfer.IncomingTransfer",
+                         direction: Cashless.FileTransferDirection, reason: str):
+        logger.warning(f"Abandoning file {failed.file_id} ({direction.name.lower()}): {reason}")
+        if self._wants(Cashless.MdbCommand.FILE_TRANSFER_FAILED):
+            self._publish(Cashless.FileTransferFailedCommandEvent(failed.file_id, direction, reason))
+
+    def _start_outgoing_transfer(self):
+        self.outgoing_transfer.start()
+        self._fill_ftl_window()
+
+    def _fill_ftl_window(self):
+        # Build the next few SEND BLOCK responses now, so a POLL only has to pop a ready made response
+        while self.outgoing_transfer is not None and len(self._ftl_blocks) < self.ftl_window:
+            block = self.outgoing_transfer.next_block()
+            if block is None:
+                break
+            self._ftl_blocks.append(block)
+
+    def _send_ftl_block(self):
+        block = self._ftl_blocks.popleft()
+        try:
+            self._send_cmd(block[0])
+        except SERIAL_ERRORS:
+            self._ftl_blocks.appendleft(block)
+            raise
+
+        self.metric_ftl_bytes_sent.inc(block[1])
+        outgoing = self.outgoing_transfer
+        if outgoing is None:
+            return  # cancelled while the block was being sent
+        outgoing.mark_sent(block[1])
+        if outgoing.complete:
+            logger.info(f"Sent file {outgoing.file_id} ({outgoing.size} bytes) at {outgoing.bytes_per_second:.0f} B/s")
+            self.outgoing_transfer = None
+            if self._wants(Cashless.MdbCommand.FILE_SENT):
+                self._publish(Cashless.FileSentCommandEvent(outgoing.file_id, outgoing.size,
+                                                            outgoing.bytes_per_second))
+        else:
+            self._fill_ftl_window()
+
+    def _cancel_outgoing_transfer(self):
+        self.outgoing_transfer = None
+        self._ftl_blocks.clear()
+
     def process_cmd(self, raw_cmd: str):
         try:
             addressed_cmd = Cashless.AddressedMdbCommand(raw_cmd)
@@ -246,21 +640,26 @@ class CashlessPeripheral(Peripheral):
             if cmd == protocol.MdbCommand.ACK:
                 if self.report_acks:
                     logger.debug("Got ACK")
-                    self.event_queue.put(protocol.AckCommandEvent())
+                if self._wants(protocol.MdbCommand.ACK, self.report_acks):
+                    self._publish(protocol.AckCommandEvent(), self.report_acks)
 
             elif cmd == protocol.MdbCommand.RET:
                 logger.warning("Got RET :(")
-                self.event_queue.put(protocol.RetCommandEvent())
+                if self._wants(protocol.MdbCommand.RET):
+                    self._publish(protocol.RetCommandEvent())
 
             elif cmd == protocol.MdbCommand.NAK:
                 logger.warning("Got NAK")
-                self.event_queue.put(protocol.NakCommandEvent())
+                if self._wants(protocol.MdbCommand.NAK):
+                    self._publish(protocol.NakCommandEvent())
 
             elif cmd == Cashless.MdbCommand.RESET:
                 self.send_ack()
                 logger.debug("Got CSH RESET")
                 self.reader_state = Cashless.State.INACTIVE
-                self.event_queue.put(protocol.MdbCommandEvent(Cashless.MdbCommand.RESET))
+                self.cancel_transfers("the VMC reset us")
+                if self._wants(Cashless.MdbCommand.RESET):
+                    self._publish(protocol.MdbCommandEvent(Cashless.MdbCommand.RESET))
 
             elif cmd == Cashless.MdbCommand.SETUP_CONFIG_DATA:
                 logger.debug("Got CSH SETUP Config Data")
@@ -271,9 +670,10 @@ class CashlessPeripheral(Peripheral):
                 logger.debug(f"VMC feature level: {raw_feature_level} Columns on display: {columns_on_display} "
                             f"Rows on display: {rows_on_display} Display type: {raw_display_type}")
 
-                display = Cashless.VmcDisplay(rows_on_display, columns_on_display, raw_display_type)
                 feature_level = Vmc.FeatureLevel(raw_feature_level)
-                self.event_queue.put(Cashless.SetupConfigDataCommandEvent(feature_level, display))
+                if self._wants(Cashless.MdbCommand.SETUP_CONFIG_DATA):
+                    display = Cashless.VmcDisplay(rows_on_display, columns_on_display, raw_display_type)
+                    self._publish(Cashless.SetupConfigDataCommandEvent(feature_level, display))
 
             elif cmd == Cashless.MdbCommand.SETUP_PRICE_DATA:
                 self.send_ack()
@@ -282,9 +682,13 @@ class CashlessPeripheral(Peripheral):
                 logger.debug(f"Got CSH SETUP Min/Max Prices. Min: {min_price} Max: {max_price}")
                 self.reader_state = Cashless.State.DISABLED
 
-                self.event_queue.put(Cashless.SetupPriceCommandEvent(min_price, max_price))
+                if self._wants(Cashless.MdbCommand.SETUP_PRICE_DATA):
+                    self._publish(Cashless.SetupPriceCommandEvent(min_price, max_price))
 
             elif cmd == Cashless.MdbCommand.POLL:
+                if self.ftl_timeout and (self.outgoing_transfer is not None or self.incoming_transfer is not None):
+                    self._expire_transfers()
+
                 if self.reader_state == Cashless.State.INACTIVE:
                     self._send_just_reset()
                     self.reader_state = Cashless.State.DISABLED
@@ -293,13 +697,21 @@ class CashlessPeripheral(Peripheral):
                 elif not self.mdb_send_queue.empty():
                     queued_command = self.mdb_send_queue.get()
                     mdb_command = queued_command.get("mdb_command")
-                    self._send_cmd(mdb_command)
+                    try:
+                        self._send_cmd(mdb_command)
+                    except SERIAL_ERRORS:
+                        # don't lose the response if the device disappears mid send
+                        self._requeue_poll_response(queued_command)
+                        raise
                     self.mdb_send_queue.task_done()
+                elif self._ftl_blocks:
+                    # file blocks only go out when there's nothing more urgent (like a vend approval) to send
+                    self._send_ftl_block()
                 else:
                     self.send_ack()
 
-                if SEND_POLL_COMMANDS:
-                    self.event_queue.put(protocol.MdbCommandEvent(Cashless.MdbCommand.POLL))
+                if self._wants(Cashless.MdbCommand.POLL, SEND_POLL_COMMANDS):
+                    self._publish(protocol.MdbCommandEvent(Cashless.MdbCommand.POLL), SEND_POLL_COMMANDS)
 
             elif cmd == Cashless.MdbCommand.VEND_REQUEST:
                 self.send_ack()
@@ -307,53 +719,66 @@ class CashlessPeripheral(Peripheral):
                 item_number = None if helpers.hex_to_int(raw_cmd[8:12]) == protocol.UNKNOWN_ITEM_NUMBER else helpers.hex_to_int(raw_cmd[8:12])
                 logger.debug(f"Got VEND REQUEST. Item price: {item_price} cents Item number: {item_number}")
                 self.reader_state = Cashless.State.VEND
+                self._journal_record(RecordType.VEND_REQUEST, price=item_price.cents, item=item_number)
 
-                self.event_queue.put(Cashless.VendRequestCommandEvent(item_price, item_number))
+                if self._wants(Cashless.MdbCommand.VEND_REQUEST):
+                    self._publish(Cashless.VendRequestCommandEvent(item_price, item_number))
 
             elif cmd == Cashless.MdbCommand.VEND_CANCEL:
                 logger.debug("Got VEND CANCEL REQUEST")
                 self.deny_vend()
                 self.reader_state = Cashless.State.ENABLED
-                self.event_queue.put(protocol.MdbCommandEvent(Cashless.MdbCommand.VEND_CANCEL))
+                self._journal_record(RecordType.VEND_CANCEL)
+                if self._wants(Cashless.MdbCommand.VEND_CANCEL):
+                    self._publish(protocol.MdbCommandEvent(Cashless.MdbCommand.VEND_CANCEL))
 
             elif cmd == Cashless.MdbCommand.VEND_SUCCESS:
                 self.send_ack()
                 item_number = None if helpers.hex_to_int(raw_cmd[4:8]) == protocol.UNKNOWN_ITEM_NUMBER else helpers.hex_to_int(raw_cmd[4:8])
                 logger.debug(f"Got VEND SUCCESS. Item number: {item_number}")
                 self.reader_state = Cashless.State.ENABLED
+                self._journal_record(RecordType.VEND_SUCCESS, item=item_number)
 
-                self.event_queue.put(Cashless.VendSuccessCommandEvent(item_number))
+                if self._wants(Cashless.MdbCommand.VEND_SUCCESS):
+                    self._publish(Cashless.VendSuccessCommandEvent(item_number))
 
             elif cmd == Cashless.MdbCommand.VEND_FAILURE:
                 self.send_ack()
                 logger.debug("Got VEND FAILURE.")
                 self.reader_state = Cashless.State.ENABLED
-                self.event_queue.put(protocol.MdbCommandEvent(Cashless.MdbCommand.VEND_FAILURE))
+                self._journal_record(RecordType.VEND_FAILURE)
+                if self._wants(Cashless.MdbCommand.VEND_FAILURE):
+                    self._publish(protocol.MdbCommandEvent(Cashless.MdbCommand.VEND_FAILURE))
 
             elif cmd == Cashless.MdbCommand.VEND_SESSION_COMPLETE:
                 self.send_ack()
                 logger.debug("Got VEND SESSION COMPLETE.")
-                self.event_queue.put(protocol.MdbCommandEvent(Cashless.MdbCommand.VEND_SESSION_COMPLETE))
+                if self._wants(Cashless.MdbCommand.VEND_SESSION_COMPLETE):
+                    self._publish(protocol.MdbCommandEvent(Cashless.MdbCommand.VEND_SESSION_COMPLETE))
                 self.reader_state = Cashless.State.ENABLED
+                self._journal_record(RecordType.SESSION_COMPLETE)
                 self.end_session()
 
             elif cmd == Cashless.MdbCommand.READER_DISABLE:
                 self.send_ack()
                 logger.debug("Got CSH READER DISABLE.")
                 self.reader_state = Cashless.State.DISABLED
-                self.event_queue.put(protocol.MdbCommandEvent(Cashless.MdbCommand.READER_DISABLE))
+                if self._wants(Cashless.MdbCommand.READER_DISABLE):
+                    self._publish(protocol.MdbCommandEvent(Cashless.MdbCommand.READER_DISABLE))
 
             elif cmd == Cashless.MdbCommand.READER_ENABLE:
                 self.send_ack()
                 logger.debug("Got CSH READER ENABLE")
                 self.reader_state = Cashless.State.ENABLED
-                self.event_queue.put(protocol.MdbCommandEvent(Cashless.MdbCommand.READER_ENABLE))
+                if self._wants(Cashless.MdbCommand.READER_ENABLE):
+                    self._publish(protocol.MdbCommandEvent(Cashless.MdbCommand.READER_ENABLE))
 
             elif cmd == Cashless.MdbCommand.READER_CANCEL:
                 self.cancelled()
                 logger.debug("Got CSH READER CANCEL")
                 self.reader_state = Cashless.State.ENABLED
-                self.event_queue.put(protocol.MdbCommandEvent(Cashless.MdbCommand.READER_CANCEL))
+                if self._wants(Cashless.MdbCommand.READER_CANCEL):
+                    self._publish(protocol.MdbCommandEvent(Cashless.MdbCommand.READER_CANCEL))
 
             elif cmd == Cashless.MdbCommand.EXPANSION_REQUEST_ID:
                 manufacturer_code = helpers.get_ascii_from_hex(raw_cmd[4:10])
@@ -363,15 +788,145 @@ class CashlessPeripheral(Peripheral):
                 logger.debug(
                     f"Got CSH EXPANSION. Mfr: {manufacturer_code} Serial: {serial_number} Model: {model_number} Software Version: {software_version}")
 
-                self.event_queue.put(Cashless.ExpansionRequestIdCommandEvent(manufacturer_code, serial_number, model_number,
-                                                                             software_version))
+                if self._wants(Cashless.MdbCommand.EXPANSION_REQUEST_ID):
+                    self._publish(Cashless.ExpansionRequestIdCommandEvent(manufacturer_code, serial_number,
+                                                                          model_number, software_version))
+
+            elif cmd == Cashless.MdbCommand.EXPANSION_READ_USER_FILE:
+                file_number = helpers.hex_to_int(raw_cmd[4:6])
+                data = self.user_files.get(file_number, b"")  # a file we don't have is sent with a length of 0
+                logger.debug(f"Got CSH EXPANSION READ USER FILE. File: {file_number} Length: {len(data)}")
+                if len(data) > transfer.MAX_USER_FILE_SIZE:
+                    logger.error(f"User file {file_number} is {len(data)} bytes, more than the "
+                                 f"{transfer.MAX_USER_FILE_SIZE} that fit in a response. Sending it as empty")
+                    data = b""
+                self._send_cmd(Cashless.MdbResponse.USER_FILE_DATA.build(file_number, data))
+
+            elif cmd == Cashless.MdbCommand.EXPANSION_WRITE_USER_FILE:
+                self.send_ack()
+                file_number = helpers.hex_to_int(raw_cmd[4:6])
+                length = helpers.hex_to_int(raw_cmd[6:8])
+                data = bytes.fromhex(raw_cmd[8:8 + length * 2])
+                logger.debug(f"Got CSH EXPANSION WRITE USER FILE. File: {file_number} Length: {length}")
+                if len(data) > transfer.MAX_USER_FILE_SIZE:
+                    logger.warning(f"Ignoring a {len(data)} byte write to user file {file_number}, the most is "
+                                   f"{transfer.MAX_USER_FILE_SIZE} bytes")
+                    return
+                self.user_files[file_number] = data
+
+                if self._wants(Cashless.MdbCommand.EXPANSION_WRITE_USER_FILE):
+                    self._publish(Cashless.UserFileWriteCommandEvent(file_number, data))
+
+            elif cmd == Cashless.MdbCommand.EXPANSION_REQ_TO_SEND:
+                # the VMC wants to send us a file
+                destination = helpers.hex_to_int(raw_cmd[4:6])
+                source = helpers.hex_to_int(raw_cmd[6:8])
+                file_id = helpers.hex_to_int(raw_cmd[8:10])
+                block_count = helpers.hex_to_int(raw_cmd[10:12])
+                logger.debug(f"Got FTL REQ TO SEND. File: {file_id} Blocks: {block_count}")
+
+                incoming = self.incoming_transfer
+                if incoming is None:
+                    try:
+                        self.incoming_transfer = transfer.IncomingTransfer(file_id, block_count, destination, source)
+                    except ValueError as e:
+                        logger.warning(f"Refusing FTL REQ TO SEND: {e}")
+                        self._send_cmd(Cashless.MdbResponse.RETRY_DENY.build(source, destination, 0))
+                    else:
+                        self._send_cmd(Cashless.MdbResponse.OK_TO_SEND.build(source, destination))
+                elif incoming.file_id == file_id and not incoming.size_known and incoming.started_at is None:
+                    # the VMC is answering our REQ TO RCV
+                    try:
+                        incoming.set_block_count(block_count)
+                    except ValueError as e:
+                        self._abandon_incoming_transfer(f"refused the VMC's REQ TO SEND: {e}")
+                        self._send_cmd(Cashless.MdbResponse.RETRY_DENY.build(source, destination, 0))
+                    else:
+                        self._send_cmd(Cashless.MdbResponse.OK_TO_SEND.build(source, destination))
+                else:
+                    logger.warning("Already receiving a file, asking the VMC to retry")
+                    self._send_cmd(Cashless.MdbResponse.RETRY_DENY.build(source, destination, 1))
+
+            elif cmd == Cashless.MdbCommand.EXPANSION_SEND_BLOCK:
+                self.send_ack()
+                incoming = self.incoming_transfer
+                if incoming is None:
+                    logger.warning("Got FTL SEND BLOCK without a transfer in progress, discarding")
+                    return
+
+                try:
+                    block_number = helpers.hex_to_int(raw_cmd[6:8])
+                    data = bytes.fromhex(raw_cmd[8:])
+                    incoming.add_block(block_number, data)
+                except ValueError as e:
+                    # the rest of the file can't be trusted, so give up on it rather than blocking later transfers
+                    self._abandon_incoming_transfer(f"bad SEND BLOCK ({raw_cmd}): {e}")
+                    return
+                self.metric_ftl_bytes_received.inc(len(data))
 
-            else:
-                if self.enable_unsupported_commands:
-                    logger.debug("Received unknown mdb command: " + raw_cmd)
-                    self.event_queue.put(protocol.UnknownCommandEvent(raw_cmd))
+                if incoming.complete:
+                    logger.info(f"Received file {incoming.file_id} ({incoming.size} bytes) at "
+                                f"{incoming.bytes_per_second:.0f} B/s")
+                    self.incoming_transfer = None
+                    if self._wants(Cashless.MdbCommand.FILE_RECEIVED):
+                        self._publish(Cashless.FileReceivedCommandEvent(incoming.file_id, incoming.data,
+                                                                        incoming.bytes_per_second))
+
+            elif cmd == Cashless.MdbCommand.EXPANSION_OK_TO_SEND:
+                self.send_ack()
+                logger.debug("Got FTL OK TO SEND")
+                if self.outgoing_transfer is not None:
+                    self._start_outgoing_transfer()
+
+            elif cmd == Cashless.MdbCommand.EXPANSION_REQ_TO_RCV:
+                # the VMC wants a file from us
+                destination = helpers.hex_to_int(raw_cmd[4:6])
+                source = helpers.hex_to_int(raw_cmd[6:8])
+                file_id = helpers.hex_to_int(raw_cmd[8:10])
+                max_blocks = helpers.hex_to_int(raw_cmd[10:12])
+                logger.debug(f"Got FTL REQ TO RCV. File: {file_id} Max blocks: {max_blocks}")
+
+                outgoing = None
+                if file_id in self.ftl_files and self.outgoing_transfer is None:
+                    outgoing = transfer.OutgoingTransfer(file_id, self.ftl_files[file_id], source, destination)
+                    if outgoing.block_count > max_blocks:
+                        logger.warning(f"File {file_id} is {outgoing.block_count} blocks, the VMC will only take "
+                                       f"{max_blocks}")
+                        outgoing = None
+
+                if outgoing is not None:
+                    self.send_ack()
+                    self.outgoing_transfer = outgoing
+                    self._start_outgoing_transfer()
                 else:
-                    logger.debug("Received unknown mdb command: " + raw_cmd)
+                    self._send_cmd(Cashless.MdbResponse.RETRY_DENY.build(source, destination, 0))
+
+            elif cmd == Cashless.MdbCommand.EXPANSION_RETRY_DENY:
+                self.send_ack()
+                retry_delay = helpers.hex_to_int(raw_cmd[8:10])
+                logger.warning(f"Got FTL RETRY/DENY. Retry delay: {retry_delay}")
+
+                # RETRY/DENY doesn't say which file it's about. It answers our REQ TO SEND or REQ TO RCV, so it applies
+                # to whichever transfer hasn't started yet, or to both if neither has.
+                transfers = [(t, d) for t, d in ((self.outgoing_transfer, Cashless.FileTransferDirection.SEND),
+                                                 (self.incoming_transfer, Cashless.FileTransferDirection.RECEIVE))
+                             if t is not None]
+                denied = [(t, d) for t, d in transfers if t.started_at is None] or transfers
+
+                for denied_transfer, direction in denied:
+                    reason = f"denied by the VMC (retry delay {retry_delay})"
+                    if direction == Cashless.FileTransferDirection.SEND:
+                        self._abandon_outgoing_transfer(reason)
+                    else:
+                        self._abandon_incoming_transfer(reason)
+                    if self._wants(Cashless.MdbCommand.EXPANSION_RETRY_DENY):
+                        self._publish(Cashless.FileTransferDeniedCommandEvent(denied_transfer.file_id, direction,
+                                                                              retry_delay))
+
+            else:
+                logger.debug("Received unknown mdb command: " + raw_cmd)
+                if self._wants(protocol.MdbCommand.UNKNOWN, self.enable_unsupported_commands):
+                    self._publish(protocol.UnknownCommandEvent(raw_cmd), self.enable_unsupported_commands)
 
         except ValueError as e:
             # TODO: remove after development
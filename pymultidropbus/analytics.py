@@ -0,0 +1,375 @@
+import itertools
+import logging
+import math
+from collections import Counter
+from dataclasses import dataclass, field
+
+import numpy as np
+
+import pymultidropbus.protocol as protocol
+import pymultidropbus.protocol.peripherals.Cashless as Cashless
+
+logger = logging.getLogger("pymultidropbus:analytics")
+
+# Capture logs are plain text with one frame per line in the format "<timestamp> <direction> <hex>", for example:
+#
+#   1697712345.120301 > 1300012C0005
+#   1697712345.124012 < 00
+#
+# The timestamp is in seconds (float), the direction is ">" for frames sent by the VMC and "<" for frames sent by the
+# peripheral, and the hex is the frame without its checksum byte (exactly what is passed to process_cmd / _send_cmd).
+# Peripheral(capture=...) writes this format for every frame it receives or sends. Lines starting with "#" are
+# ignored. Malformed lines (e.g. a torn last line in a live capture) and frames longer than MAX_FRAME_BYTES are skipped
+# and counted rather than aborting the whole analysis.
+VMC_TO_PERIPHERAL = 0
+PERIPHERAL_TO_VMC = 1
+
+MAX_FRAME_BYTES = 36
+DEFAULT_CHUNK_SIZE = 65536  # lines per chunk, keeps memory bounded regardless of the size of the capture
+POLL_RESPONSE_DEADLINE = 0.005  # the peripheral must respond within 5ms (t-response in the MDB spec)
+
+FRAME_DTYPE = np.dtype([
+    ("timestamp", "f8"),
+    ("direction", "u1"),
+    ("address", "u1"),
+    ("device", "u1"),  # Cashless.CashlessDeviceAddress value
+    ("command", "i2"),  # Cashless.MdbCommand value (or VEND_CASH_SALE) for VMC frames, -1 otherwise
+    ("response", "i2"),  # first byte of peripheral frames, -1 otherwise
+    ("length", "u1"),  # in bytes
+    ("price", "u4"),  # in VMC cents, 0 if the frame has no price
+    ("item", "u4"),  # protocol.UNKNOWN_ITEM_NUMBER if the frame has no item number
+])
+
+# Cashless.MdbCommand.VEND_CASH_SALE is an alias of VEND_SESSION_COMPLETE (both are 8), so cash sales get a code of
+# their own in the "command" column, after every MdbCommand value. Unknown commands are counted after that.
+VEND_CASH_SALE = len(Cashless.MdbCommand)
+_UNKNOWN_COMMAND = VEND_CASH_SALE + 1
+
+_RAW_DTYPE = np.dtype([("timestamp", "f8"), ("direction", "S1"), ("frame", f"S{MAX_FRAME_BYTES * 2}")])
+
+
+def _build_hex_table():
+    table = np.zeros(256, dtype=np.uint8)
+    for i, char in enumerate(b"0123456789ABCDEF"):
+        table[char] = i
+        table[ord(chr(char).lower())] = i
+    return table
+
+
+def _build_command_tables():
+    # lookup tables indexed by [address byte, sub command byte] that mirror what AddressedMdbCommand does
+    commands = np.full((256, 256), -1, dtype=np.int16)
+    devices = np.zeros(256, dtype=np.uint8)
+
+    for enum_class, device in ((Cashless.PrimaryAddressMdbCommand, Cashless.CashlessDeviceAddress.PRIMARY),
+                               (Cashless.SecondaryAddressMdbCommand, Cashless.CashlessDeviceAddress.SECONDARY)):
+        # commands without a sub command (RESET, POLL) match every sub command byte, so fill those rows first
+        for enum in sorted(enum_class, key=lambda e: len(e.value)):
+            value = VEND_CASH_SALE if enum.name == "VEND_CASH_SALE" else Cashless.MdbCommand[enum.name].value
+            address = int(enum.value[0:2], 16)
+            devices[address] = device.value
+            if len(enum.value) == 2:
+                commands[address, :] = value
+            else:
+                commands[address, int(enum.value[2:4], 16)] = value
+
+    return commands, devices
+
+
+_HEX_TABLE = _build_hex_table()
+_COMMAND_TABLE, _DEVICE_TABLE = _build_command_tables()
+
+_VEND_REQUEST = Cashless.MdbCommand.VEND_REQUEST.value
+_VEND_SUCCESS = Cashless.MdbCommand.VEND_SUCCESS.value
+_POLL = Cashless.MdbCommand.POLL.value
+_APPROVE_VEND = int(Cashless.MdbResponse.APPROVE_VEND.value, 16)
+_DENY_VEND = int(Cashless.MdbResponse.DENY_VEND.value, 16)
+_BEGIN_SESSION = int(Cashless.MdbResponse.BEGIN_SESSION.value, 16)
+
+VEND_OUTCOME_COMMANDS = (
+    Cashless.MdbCommand.VEND_SUCCESS,
+    Cashless.MdbCommand.VEND_FAILURE,
+    Cashless.MdbCommand.VEND_CANCEL,
+)
+VEND_OUTCOME_RESPONSES = (
+    Cashless.MdbResponse.APPROVE_VEND,
+    Cashless.MdbResponse.DENY_VEND,
+)
+
+
+def decode_frames(raw: np.ndarray) -> np.ndarray:
+    """Decodes an array of (timestamp, direction, frame) records into a FRAME_DTYPE array."""
+    count = len(raw)
+    frames = np.zeros(count, dtype=FRAME_DTYPE)
+    if not count:
+        return frames
+
+    # view the fixed width hex strings as a 2D array of ascii codes, then combine each pair of nibbles into a byte
+    hex_chars = np.ascontiguousarray(raw["frame"]).view(np.uint8).reshape(count, MAX_FRAME_BYTES * 2)
+    nibbles = _HEX_TABLE[hex_chars].astype(np.uint32)
+    data = (nibbles[:, 0::2] << 4) | nibbles[:, 1::2]
+
+    is_vmc = raw["direction"] == b">"
+    is_peripheral = ~is_vmc
+    address = data[:, 0]
+    sub_command = data[:, 1]
+
+    frames["timestamp"] = raw["timestamp"]
+    frames["direction"] = np.where(is_vmc, VMC_TO_PERIPHERAL, PERIPHERAL_TO_VMC)
+    frames["length"] = np.char.str_len(raw["frame"]) // 2
+    frames["address"] = np.where(is_vmc, address, 0)
+    frames["device"] = np.where(is_vmc, _DEVICE_TABLE[address], Cashless.CashlessDeviceAddress.UNKNOWN.value)
+    command = np.where(is_vmc, _COMMAND_TABLE[address, sub_command], -1)
+    response = np.where(is_peripheral, address, -1)
+    frames["command"] = command
+    frames["response"] = response
+
+    # VEND REQUEST: 13 00 [price] [item], VEND SUCCESS: 13 02 [item], APPROVE VEND / BEGIN SESSION: 05 [amount]
+    is_vend_request = command == _VEND_REQUEST
+    has_response_amount = (response == _APPROVE_VEND) | (response == _BEGIN_SESSION)
+    frames["price"] = np.select(
+        [is_vend_request, has_response_amount],
+        [(data[:, 2] << 8) | data[:, 3], (data[:, 1] << 8) | data[:, 2]],
+        0,
+    )
+    frames["item"] = np.select(
+        [is_vend_request, command == _VEND_SUCCESS],
+        [(data[:, 4] << 8) | data[:, 5], (data[:, 2] << 8) | data[:, 3]],
+        protocol.UNKNOWN_ITEM_NUMBER,
+    )
+    return frames
+
+
+def _split_line(line: str):
+    # returns a (timestamp, direction, frame) record, or the reason the line was skipped
+    fields = line.split()
+    if len(fields) != 3 or fields[1] not in (">", "<"):
+        return "malformed"
+    timestamp, direction, frame = fields
+    try:
+        timestamp = float(timestamp)
+        bytes.fromhex(frame)
+    except ValueError:
+        return "malformed"
+    if not frame or len(frame) > MAX_FRAME_BYTES * 2:
+        return "oversized" if frame else "malformed"
+    return timestamp, direction.encode(), frame.encode()
+
+
+def parse_frames(lines, skipped: Counter = None) -> np.ndarray:
+    """Parses an iterable of capture log lines into a FRAME_DTYPE array.
+
+    Lines that can't be parsed are left out, and counted by reason ("malformed" or "oversized") in skipped if given.
+    """
+    records = []
+    for line in lines:
+        if not line.strip() or line.startswith("#"):
+            continue
+        record = _split_line(line)
+        if isinstance(record, str):
+            if skipped is not None:
+                skipped[record] += 1
+            continue
+        records.append(record)
+
+    if not records:
+        return np.zeros(0, dtype=FRAME_DTYPE)
+    return decode_frames(np.array(records, dtype=_RAW_DTYPE))
+
+
+def read_frames(path: str, chunk_size: int = DEFAULT_CHUNK_SIZE, skipped: Counter = None):
+    """Yields FRAME_DTYPE arrays of at most chunk_size frames from a capture log."""
+    with open(path, "r") as capture:
+        while True:
+            lines = list(itertools.islice(capture, chunk_size))
+            if not lines:
+                return
+            frames = parse_frames(lines, skipped)
+            if len(frames):
+                yield frames
+
+
+def pair_intervals(timestamps: np.ndarray, is_start: np.ndarray, is_end: np.ndarray, carry: float = math.nan,
+                   is_cancel: np.ndarray = None):
+    """Pairs every end event with the most recent start event since the previous end event.
+
+    A cancel event (if is_cancel is given) discards any start event before it, so the next end event only pairs with a
+    start event that comes after the cancel.
+
+    Returns the interval between each pair, and the timestamp of a trailing unmatched start event (or nan) that should
+    be passed in as the carry for the next chunk.
+    """
+    if is_cancel is None:
+        is_cancel = np.zeros(len(timestamps), dtype=bool)
+    if not math.isnan(carry):
+        timestamps = np.concatenate(([carry], timestamps))
+        is_start = np.concatenate(([True], is_start))
+        is_end = np.concatenate(([False], is_end))
+        is_cancel = np.concatenate(([False], is_cancel))
+
+    if not len(timestamps):
+        return np.zeros(0, dtype=np.float64), carry
+
+    index = np.arange(len(timestamps))
+    last_start = np.maximum.accumulate(np.where(is_start, index, -1))
+    last_end = np.maximum.accumulate(np.where(is_end, index, -1))
+    last_cancel = np.maximum.accumulate(np.where(is_cancel, index, -1))
+
+    ends = np.flatnonzero(is_end)
+    previous_end = np.concatenate(([-1], last_end[:-1]))[ends]
+    starts = last_start[ends]
+    matched = (starts > previous_end) & (starts > last_cancel[ends])
+    intervals = timestamps[ends[matched]] - timestamps[starts[matched]]
+
+    pending = last_start[-1] > last_end[-1] and last_start[-1] > last_cancel[-1]
+    new_carry = timestamps[last_start[-1]] if pending else math.nan
+    return intervals, float(new_carry)
+
+
+@dataclass
+class IntervalStats:
+    # Summary statistics and a fixed histogram, so memory doesn't grow with the number of intervals
+    bins: np.ndarray
+    count: int = 0
+    total: float = 0.0
+    total_squares: float = 0.0
+    minimum: float = math.inf
+    maximum: float = -math.inf
+    histogram: np.ndarray = field(init=False)
+
+    def __post_init__(self):
+        self.histogram = np.zeros(len(self.bins) - 1, dtype=np.int64)
+
+    def update(self, values: np.ndarray):
+        if not len(values):
+            return
+        self.count += len(values)
+        self.total += float(values.sum())
+        self.total_squares += float(np.square(values).sum())
+        self.minimum = min(self.minimum, float(values.min()))
+        self.maximum = max(self.maximum, float(values.max()))
+        self.histogram += np.histogram(values, bins=self.bins)[0]
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else math.nan
+
+    @property
+    def std(self) -> float:
+        if not self.count:
+            return math.nan
+        return math.sqrt(max(self.total_squares / self.count - self.mean ** 2, 0.0))
+
+
+def _default_interval_bins():
+    # 100us to 10 minutes, logarithmically spaced
+    return np.geomspace(1e-4, 600, 64)
+
+
+class CaptureAnalyzer:
+    """Accumulates fleet statistics over a stream of FRAME_DTYPE chunks."""
+
+    def __init__(self, price_bins: np.ndarray = None, interval_bins: np.ndarray = None,
+                 poll_response_deadline: float = POLL_RESPONSE_DEADLINE):
+        if price_bins is None:
+            price_bins = np.arange(0, protocol.MAX_MONEY_VALUE + 51, 50)
+        if interval_bins is None:
+            interval_bins = _default_interval_bins()
+
+        self.poll_response_deadline = poll_response_deadline
+        self.frame_count = 0
+        self.skipped_lines = Counter()  # lines left out of the analysis, by reason ("malformed" or "oversized")
+        # indexed by the "command" column, with VEND_CASH_SALE and unknown commands in the last two buckets
+        self.command_counts = np.zeros(_UNKNOWN_COMMAND + 1, dtype=np.int64)
+        self.response_counts = np.zeros(256, dtype=np.int64)
+        self.price_bins = price_bins
+        self.price_histogram = np.zeros(len(price_bins) - 1, dtype=np.int64)
+
+        self.session_durations = IntervalStats(interval_bins)
+        self.approval_latencies = IntervalStats(interval_bins)
+        self.poll_intervals = IntervalStats(interval_bins)
+        self.poll_response_latencies = IntervalStats(interval_bins)
+        self.poll_count = 0
+        self.late_poll_responses = 0
+
+        self._session_carry = math.nan
+        self._approval_carry = math.nan
+        self._poll_response_carry = math.nan
+        self._last_poll = math.nan
+
+    def update(self, frames: np.ndarray):
+        if not len(frames):
+            return
+
+        self.frame_count += len(frames)
+        timestamps = frames["timestamp"]
+        command = frames["command"]
+        response = frames["response"]
+        is_vmc = frames["direction"] == VMC_TO_PERIPHERAL
+        is_peripheral = ~is_vmc
+
+        vmc_commands = command[is_vmc]
+        self.command_counts += np.bincount(np.where(vmc_commands < 0, _UNKNOWN_COMMAND, vmc_commands),
+                                           minlength=len(self.command_counts))
+        self.response_counts += np.bincount(response[is_peripheral], minlength=256)
+
+        is_vend_request = command == _VEND_REQUEST
+        self.price_histogram += np.histogram(frames["price"][is_vend_request], bins=self.price_bins)[0]
+
+        # BEGIN SESSION -> VEND SESSION COMPLETE
+        durations, self._session_carry = pair_intervals(
+            timestamps, response == _BEGIN_SESSION,
+            command == Cashless.MdbCommand.VEND_SESSION_COMPLETE.value, self._session_carry)
+        self.session_durations.update(durations)
+
+        # VEND REQUEST -> APPROVE VEND / DENY VEND
+        latencies, self._approval_carry = pair_intervals(
+            timestamps, is_vend_request, (response == _APPROVE_VEND) | (response == _DENY_VEND), self._approval_carry)
+        self.approval_latencies.update(latencies)
+
+        # POLL -> whatever the peripheral sends next (ACK, JUST RESET or a queued response). Any other VMC frame before
+        # the response means the POLL went unanswered, so the response belongs to that frame instead.
+        is_poll = command == _POLL
+        latencies, self._poll_response_carry = pair_intervals(
+            timestamps, is_poll, is_peripheral, self._poll_response_carry, is_vmc & ~is_poll)
+        self.poll_response_latencies.update(latencies)
+        self.late_poll_responses += int(np.count_nonzero(latencies > self.poll_response_deadline))
+
+        poll_timestamps = timestamps[is_poll]
+        self.poll_count += len(poll_timestamps)
+        if len(poll_timestamps):
+            if not math.isnan(self._last_poll):
+                poll_timestamps = np.concatenate(([self._last_poll], poll_timestamps))
+            self.poll_intervals.update(np.diff(poll_timestamps))
+            self._last_poll = float(poll_timestamps[-1])
+
+    @property
+    def unanswered_polls(self) -> int:
+        return self.poll_count - self.poll_response_latencies.count
+
+    @property
+    def missed_poll_deadlines(self) -> int:
+        return self.late_poll_responses + self.unanswered_polls
+
+    @property
+    def poll_jitter(self) -> float:
+        """Standard deviation of the time between POLLs, in seconds."""
+        return self.poll_intervals.std
+
+    def vend_outcome_counts(self) -> dict:
+        counts = {command.name: int(self.command_counts[command.value]) for command in VEND_OUTCOME_COMMANDS}
+        counts["VEND_CASH_SALE"] = int(self.command_counts[VEND_CASH_SALE])
+        for response in VEND_OUTCOME_RESPONSES:
+            counts[response.name] = int(self.response_counts[int(response.value, 16)])
+        return counts
+
+
+def analyse_capture(path: str, chunk_size: int = DEFAULT_CHUNK_SIZE, **kwargs) -> CaptureAnalyzer:
+    """Streams a capture log through a CaptureAnalyzer in bounded memory."""
+    analyzer = CaptureAnalyzer(**kwargs)
+    for frames in read_frames(path, chunk_size, analyzer.skipped_lines):
+        analyzer.update(frames)
+    logger.debug(f"Analysed {analyzer.frame_count} frames from {path}")
+    if analyzer.skipped_lines:
+        logger.warning(f"Skipped lines in {path}: {dict(analyzer.skipped_lines)}")
+    return analyzer
@@ -0,0 +1,548 @@
+import dataclasses
+import logging
+import os
+import selectors
+import socket
+import stat
+import struct
+import threading
+import time
+from collections import deque
+from enum import Enum
+
+import pymultidropbus.protocol as protocol
+import pymultidropbus.protocol.peripherals.Cashless as Cashless
+
+logger = logging.getLogger("pymultidropbus:bridge")
+
+# Every message on the socket is a 3 byte header (message type, payload length) followed by the payload.
+HEADER = struct.Struct("!BH")
+COMMAND_CODE = struct.Struct("!BB")  # command namespace, index of the command in its enum
+RESULT = struct.Struct("!BB")  # message type of the command this is the result of, 1 if it succeeded
+MONEY = struct.Struct("!qH")  # cents, scaling factor
+INT = struct.Struct("!q")
+FLOAT = struct.Struct("!d")
+LENGTH = struct.Struct("!H")
+CENTS = struct.Struct("!q")
+
+UNKNOWN_BALANCE = -1  # START_SESSION with this balance starts a session with an unknown balance
+
+DEFAULT_MAX_PENDING_BYTES = 1024 * 1024
+
+
+class MessageType(Enum):
+    # bus process -> consumer
+    EVENT = 0x01
+    RESULT = 0x02
+
+    # consumer -> bus process
+    SUBSCRIBE = 0x10
+    APPROVE_VEND = 0x11
+    DENY_VEND = 0x12
+    START_SESSION = 0x13
+    END_SESSION = 0x14
+
+
+_NAMESPACES = (protocol.MdbCommand, Cashless.MdbCommand)
+_COMMAND_CODES = {command: (namespace, index)
+                  for namespace, enum_class in enumerate(_NAMESPACES)
+                  for index, command in enumerate(enum_class)}
+_COMMANDS_BY_CODE = {code: command for command, code in _COMMAND_CODES.items()}
+
+_EVENT_CLASSES = (
+    protocol.AckCommandEvent,
+    protocol.NakCommandEvent,
+    protocol.RetCommandEvent,
+    protocol.UnknownCommandEvent,
+    Cashless.SetupConfigDataCommandEvent,
+    Cashless.SetupPriceCommandEvent,
+    Cashless.ExpansionRequestIdCommandEvent,
+    Cashless.VendRequestCommandEvent,
+    Cashless.VendSuccessCommandEvent,
+    Cashless.UserFileWriteCommandEvent,
+    Cashless.FileReceivedCommandEvent,
+    Cashless.FileSentCommandEvent,
+    Cashless.FileTransferDeniedCommandEvent,
+    Cashless.FileTransferFailedCommandEvent,
+)
+# commands without a specific event class are published as a plain protocol.MdbCommandEvent
+_EVENT_CLASS_BY_COMMAND = {next(f.default for f in dataclasses.fields(cls) if f.name == "command"): cls
+                           for cls in _EVENT_CLASSES}
+_FIELD_CACHE = {}
+
+
+def _event_fields(cls) -> list:
+    fields = _FIELD_CACHE.get(cls)
+    if fields is None:
+        fields = [f for f in dataclasses.fields(cls) if f.init and f.name != "command"]
+        _FIELD_CACHE[cls] = fields
+    return fields
+
+
+def encode_frame(message_type: MessageType, payload: bytes = b"") -> bytes:
+    return HEADER.pack(message_type.value, len(payload)) + payload
+
+
+def _encode_value(value, parts: list):
+    if value is None:
+        parts.append(b"N")
+    elif isinstance(value, protocol.Money):
+        parts.append(b"m" + MONEY.pack(value.cents, value.scaling_factor))
+    elif isinstance(value, Enum):
+        parts.append(b"e")
+        _encode_value(value.value, parts)
+    elif isinstance(value, int):
+        parts.append(b"i" + INT.pack(value))
+    elif isinstance(value, float):
+        parts.append(b"f" + FLOAT.pack(value))
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        parts.append(b"b" + LENGTH.pack(len(value)) + bytes(value))
+    elif dataclasses.is_dataclass(value):
+        fields = [f for f in dataclasses.fields(value) if f.init]
+        parts.append(b"t" + bytes([len(fields)]))
+        for f in fields:
+            _encode_value(getattr(value, f.name), parts)
+    else:
+        encoded = str(value).encode()
+        parts.append(b"s" + LENGTH.pack(len(encoded)) + encoded)
+
+
+def _decode_value(payload: bytes, offset: int, expected_type=None):
+    tag = payload[offset:offset + 1]
+    offset += 1
+    if tag == b"N":
+        return None, offset
+    if tag == b"m":
+        cents, scaling_factor = MONEY.unpack_from(payload, offset)
+        return protocol.Money(cents, scaling_factor=scaling_factor), offset + MONEY.size
+    if tag == b"e":
+        value, offset = _decode_value(payload, offset)
+        if isinstance(expected_type, type) and issubclass(expected_type, Enum):
+            value = expected_type(value)
+        return value, offset
+    if tag == b"i":
+        return INT.unpack_from(payload, offset)[0], offset + INT.size
+    if tag == b"f":
+        return FLOAT.unpack_from(payload, offset)[0], offset + FLOAT.size
+    if tag == b"b":
+        length = LENGTH.unpack_from(payload, offset)[0]
+        offset += LENGTH.size
+        return bytes(payload[offset:offset + length]), offset + length
+    if tag == b"t":
+        count = payload[offset]
+        offset += 1
+        nested_fields = []
+        if isinstance(expected_type, type) and dataclasses.is_dataclass(expected_type):
+            nested_fields = [f for f in dataclasses.fields(expected_type) if f.init]
+        values = []
+        for i in range(count):
+            nested_type = nested_fields[i].type if i < len(nested_fields) else None
+            value, offset = _decode_value(payload, offset, nested_type)
+            values.append(value)
+        if nested_fields:
+            return expected_type(*values), offset
+        return tuple(values), offset
+    if tag == b"s":
+        length = LENGTH.unpack_from(payload, offset)[0]
+        offset += LENGTH.size
+        return payload[offset:offset + length].decode(), offset + length
+    raise ValueError(f"Unknown value tag {tag!r} in bridge event")
+
+
+def encode_event(event: protocol.MdbCommandEvent) -> bytes:
+    """Encodes an event as a complete EVENT frame."""
+    parts = [COMMAND_CODE.pack(*_COMMAND_CODES[event.command])]
+    for f in _event_fields(type(event)):
+        _encode_value(getattr(event, f.name), parts)
+    return encode_frame(MessageType.EVENT, b"".join(parts))
+
+
+def decode_event(payload: bytes) -> protocol.MdbCommandEvent:
+    """Decodes the payload of an EVENT frame back into the event it was encoded from."""
+    command = _COMMANDS_BY_CODE[COMMAND_CODE.unpack_from(payload, 0)]
+    cls = _EVENT_CLASS_BY_COMMAND.get(command, protocol.MdbCommandEvent)
+    if cls is protocol.MdbCommandEvent:
+        return cls(command)
+
+    offset = COMMAND_CODE.size
+    values = []
+    for f in _event_fields(cls):
+        value, offset = _decode_value(payload, offset, f.type)
+        values.append(value)
+    return cls(*values)
+
+
+def encode_commands(commands) -> bytes:
+    return b"".join(COMMAND_CODE.pack(*_COMMAND_CODES[command]) for command in commands)
+
+
+def decode_commands(payload: bytes) -> set:
+    return {_COMMANDS_BY_CODE[code] for code in COMMAND_CODE.iter_unpack(payload)}
+
+
+def _read_frames(buffer: bytearray):
+    # pops every complete frame off the front of buffer, leaving any partial frame behind
+    frames = []
+    offset = 0
+    while len(buffer) - offset >= HEADER.size:
+        message_type, length = HEADER.unpack_from(buffer, offset)
+        end = offset + HEADER.size + length
+        if len(buffer) < end:
+            break
+        frames.append((MessageType(message_type), bytes(buffer[offset + HEADER.size:end])))
+        offset = end
+    del buffer[:offset]
+    return frames
+
+
+class _Subscriber:
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self.commands = set()  # None means every command
+        self.inbound = bytearray()
+        self.outbound = bytearray()
+
+    def wants(self, command) -> bool:
+        return self.commands is None or command in self.commands
+
+
+class EventBridge:
+    """Publishes a peripheral's events to, and accepts commands from, other processes over a Unix socket.
+
+    Events are encoded once and appended to each subscriber's buffer, then written out by a single bridge thread. The
+    thread is only woken once per batch, so all the events from a poll cycle go out in one write per subscriber. A
+    subscriber that falls more than max_pending_bytes behind is disconnected rather than letting its buffer grow.
+    """
+
+    def __init__(self, peripheral, path: str, max_pending_bytes: int = DEFAULT_MAX_PENDING_BYTES):
+        if peripheral.dispatcher is None:
+            raise ValueError("EventBridge needs a peripheral with an EventDispatcher")
+        self.peripheral = peripheral
+        self.dispatcher = peripheral.dispatcher
+        self.path = path
+        self.max_pending_bytes = max_pending_bytes
+
+        self._lock = threading.Lock()  # protects subscriber buffers, which dispatcher workers append to
+        self._subscribers = {}  # socket -> _Subscriber
+        self._dispatcher_subscriptions = set()
+        self._selector = None
+        self._listener = None
+        self._wake_read, self._wake_write = None, None
+        self._wake_pending = False
+        self._stopping = False
+        self._thread = None
+
+    def start(self):
+        if os.path.exists(self.path):
+            if not stat.S_ISSOCK(os.stat(self.path).st_mode):
+                raise FileExistsError(f"{self.path} already exists and isn't a socket")
+            os.unlink(self.path)  # clean up a stale socket from a previous run
+
+        self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._listener.bind(self.path)
+        self._listener.listen()
+        self._listener.setblocking(False)
+        self._wake_read, self._wake_write = os.pipe()
+        os.set_blocking(self._wake_read, False)
+        os.set_blocking(self._wake_write, False)
+
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self._listener, selectors.EVENT_READ)
+        self._selector.register(self._wake_read, selectors.EVENT_READ)
+
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, name="pymultidropbus:bridge", daemon=True)
+        self._thread.start()
+        logger.info(f"Event bridge listening on {self.path}")
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stopping = True
+        self._wake()
+        self._thread.join()
+        self._thread = None
+
+        for subscriber in list(self._subscribers.values()):
+            self._disconnect(subscriber)
+        self._update_dispatcher_subscriptions()
+        self._selector.close()
+        self._listener.close()
+        os.close(self._wake_read)
+        os.close(self._wake_write)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def _on_event(self, event: protocol.MdbCommandEvent):
+        # runs on the dispatcher workers, so just encode the event and hand it to the bridge thread
+        frame = encode_event(event)
+        with self._lock:
+            for subscriber in self._subscribers.values():
+                if subscriber.wants(event.command):
+                    subscriber.outbound += frame
+        self._wake()
+
+    def _wake(self):
+        with self._lock:
+            if self._wake_pending:
+                return
+            self._wake_pending = True
+        try:
+            os.write(self._wake_write, b"\0")
+        except BlockingIOError:
+            pass  # the pipe is already full of wakeups
+
+    def _update_dispatcher_subscriptions(self):
+        # subscribe the bridge to the union of what its subscribers want, so unwanted events are never created
+        with self._lock:
+            subscribers = list(self._subscribers.values())
+        if any(subscriber.commands is None for subscriber in subscribers):
+            wanted = {None}
+        else:
+            wanted = set().union(*(subscriber.commands for subscriber in subscribers))
+
+        for command in self._dispatcher_subscriptions - wanted:
+            self.dispatcher.unsubscribe(command, self._on_event)
+        for command in wanted - self._dispatcher_subscriptions:
+            self.dispatcher.subscribe(command, self._on_event)
+        self._dispatcher_subscriptions = wanted
+
+    def _run(self):
+        while not self._stopping:
+            for key, mask in self._selector.select():
+                if key.fileobj is self._listener:
+                    self._accept()
+                elif key.fileobj == self._wake_read:
+                    self._drain_wake_pipe()
+                else:
+                    subscriber = key.data
+                    if mask & selectors.EVENT_READ:
+                        self._read(subscriber)
+                    if mask & selectors.EVENT_WRITE and subscriber.sock in self._subscribers:
+                        self._flush(subscriber)
+
+    def _accept(self):
+        try:
+            sock, _ = self._listener.accept()
+        except BlockingIOError:
+            return
+        sock.setblocking(False)
+        subscriber = _Subscriber(sock)
+        with self._lock:
+            self._subscribers[sock] = subscriber
+        self._selector.register(sock, selectors.EVENT_READ, subscriber)
+        logger.debug("Event bridge subscriber connected")
+
+    def _drain_wake_pipe(self):
+        try:
+            while os.read(self._wake_read, 4096):
+                pass
+        except BlockingIOError:
+            pass
+        with self._lock:
+            self._wake_pending = False
+            subscribers = list(self._subscribers.values())
+        for subscriber in subscribers:
+            self._flush(subscriber)
+
+    def _flush(self, subscriber: _Subscriber):
+        with self._lock:
+            if len(subscriber.outbound) > self.max_pending_bytes:
+                logger.warning(f"Event bridge subscriber is {len(subscriber.outbound)} bytes behind, disconnecting")
+                overflowed = True
+            else:
+                overflowed = False
+                pending = bytes(subscriber.outbound)
+        if overflowed:
+            self._disconnect(subscriber)
+            return
+        if not pending:
+            return
+
+        try:
+            sent = subscriber.sock.send(pending)
+        except BlockingIOError:
+            sent = 0
+        except OSError:
+            self._disconnect(subscriber)
+            return
+
+        with self._lock:
+            del subscriber.outbound[:sent]
+            backlog = bool(subscriber.outbound)
+        # only ask to be told when the socket is writable while there's a backlog, otherwise we'd spin
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if backlog else 0)
+        self._selector.modify(subscriber.sock, events, subscriber)
+
+    def _read(self, subscriber: _Subscriber):
+        try:
+            data = subscriber.sock.recv(4096)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""
+        if not data:
+            self._disconnect(subscriber)
+            return
+
+        subscriber.inbound += data
+        try:
+            for message_type, payload in _read_frames(subscriber.inbound):
+                self._handle(subscriber, message_type, payload)
+        except (ValueError, KeyError, struct.error) as e:
+            logger.warning(f"Malformed message from event bridge subscriber, disconnecting: {e}")
+            self._disconnect(subscriber)
+            return
+        except Exception:
+            # never let one subscriber take down the bridge thread for everyone else
+            logger.exception("Failed to handle a message from an event bridge subscriber, disconnecting")
+            self._disconnect(subscriber)
+            return
+        self._flush(subscriber)
+
+    def _handle(self, subscriber: _Subscriber, message_type: MessageType, payload: bytes):
+        ok = True
+        if message_type == MessageType.SUBSCRIBE:
+            commands = decode_commands(payload) if payload else None
+            with self._lock:
+                subscriber.commands = commands
+            self._update_dispatcher_subscriptions()
+        elif message_type == MessageType.APPROVE_VEND:
+            amount = CENTS.unpack(payload)[0]
+            ok = self._valid_cents(amount) and self._call(self.peripheral.approve_vend, amount)
+        elif message_type == MessageType.DENY_VEND:
+            ok = self._call(self.peripheral.deny_vend)
+        elif message_type == MessageType.START_SESSION:
+            balance = CENTS.unpack(payload)[0]
+            if balance == UNKNOWN_BALANCE:
+                ok = self._call(self.peripheral.start_cashless_session, None)
+            else:
+                ok = self._valid_cents(balance) and self._call(self.peripheral.start_cashless_session, balance)
+        elif message_type == MessageType.END_SESSION:
+            ok = self._call(self.peripheral.end_session)
+        else:
+            raise ValueError(f"Unexpected message type {message_type.name}")
+
+        with self._lock:
+            subscriber.outbound += encode_frame(MessageType.RESULT, RESULT.pack(message_type.value, int(ok)))
+
+    @staticmethod
+    def _valid_cents(cents: int) -> bool:
+        # amounts come from other processes, so check them here rather than queueing a response the VMC can't parse
+        if protocol.MIN_MONEY_VALUE <= cents <= protocol.MAX_MONEY_VALUE:
+            return True
+        logger.warning(f"Refusing an event bridge command with an amount of {cents} cents")
+        return False
+
+    @staticmethod
+    def _call(function, *args) -> bool:
+        try:
+            return function(*args) is not False  # commands that don't report success return None
+        except Exception:
+            logger.exception(f"Event bridge command {function.__name__} failed")
+            return False
+
+    def _disconnect(self, subscriber: _Subscriber):
+        with self._lock:
+            if self._subscribers.pop(subscriber.sock, None) is None:
+                return
+        try:
+            self._selector.unregister(subscriber.sock)
+        except (KeyError, ValueError):
+            pass
+        subscriber.sock.close()
+        self._update_dispatcher_subscriptions()
+        logger.debug("Event bridge subscriber disconnected")
+
+
+class BridgeClient:
+    """Connects to an EventBridge from another process.
+
+    Commands wait up to timeout seconds for their result (None waits forever) and raise TimeoutError if it doesn't
+    arrive. The bridge answers commands in the order they were sent, so a late result for a command that timed out is
+    recognised and skipped rather than being taken as the result of the next one.
+    """
+
+    def __init__(self, path: str, commands=None, timeout: float or None = 5.0):
+        self.timeout = timeout
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(path)
+        self._buffer = bytearray()
+        self._events = deque()
+        self._commands_sent = 0
+        self._results_received = 0
+        self._result = None  # (message type, ok) of the latest command, once its result has arrived
+        self.subscribe(commands)
+
+    def close(self):
+        self.sock.close()
+
+    def subscribe(self, commands=None) -> bool:
+        """Replaces this client's subscription. None subscribes to every command."""
+        payload = b"" if commands is None else encode_commands(commands)
+        return self._command(MessageType.SUBSCRIBE, payload)
+
+    def approve_vend(self, amount_charged_in_cents: int) -> bool:
+        return self._command(MessageType.APPROVE_VEND, CENTS.pack(amount_charged_in_cents))
+
+    def deny_vend(self) -> bool:
+        return self._command(MessageType.DENY_VEND)
+
+    def start_cashless_session(self, available_balance_in_cents: int = None) -> bool:
+        balance = UNKNOWN_BALANCE if available_balance_in_cents is None else available_balance_in_cents
+        return self._command(MessageType.START_SESSION, CENTS.pack(balance))
+
+    def end_session(self) -> bool:
+        return self._command(MessageType.END_SESSION)
+
+    def read_event(self, timeout: float = None) -> protocol.MdbCommandEvent or None:
+        """Returns the next event, or None if there wasn't one within timeout seconds."""
+        while not self._events:
+            if not self._receive(timeout):
+                return None
+        return self._events.popleft()
+
+    def _command(self, message_type: MessageType, payload: bytes = b"") -> bool:
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        self._result = None
+        self.sock.settimeout(self.timeout)
+        self.sock.sendall(encode_frame(message_type, payload))
+        self._commands_sent += 1
+
+        # events that arrive while we wait for the result are kept for read_event()
+        while self._result is None:
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                raise TimeoutError(f"No result for {message_type.name} from the event bridge within {self.timeout}s")
+            self._receive_frames(remaining)
+
+        result_type, ok = self._result
+        if result_type != message_type.value:
+            raise ConnectionError(f"Event bridge answered {message_type.name} with the result of another command")
+        return bool(ok)
+
+    def _receive(self, timeout: float) -> bool:
+        frames = self._receive_frames(timeout)
+        return frames is not None
+
+    def _receive_frames(self, timeout: float):
+        self.sock.settimeout(timeout)
+        try:
+            data = self.sock.recv(65536)
+        except socket.timeout:
+            return None
+        if not data:
+            raise ConnectionError("Event bridge closed the connection")
+
+        self._buffer += data
+        frames = _read_frames(self._buffer)
+        for message_type, payload in frames:
+            if message_type == MessageType.EVENT:
+                self._events.append(decode_event(payload))
+            elif message_type == MessageType.RESULT:
+                # results come back in order, so anything before the latest command's result is for one that timed out
+                self._results_received += 1
+                if self._results_received == self._commands_sent:
+                    self._result = RESULT.unpack(payload)
+        return frames
@@ -0,0 +1,136 @@
+import logging
+import threading
+from enum import Enum
+from queue import Queue
+
+import pymultidropbus.protocol as protocol
+import pymultidropbus.protocol.peripherals.Cashless as Cashless
+
+logger = logging.getLogger("pymultidropbus:dispatch")
+
+DEFAULT_PRIORITY_COMMANDS = (Cashless.MdbCommand.VEND_REQUEST,)
+
+_STOP = object()
+
+
+class EventDispatcher:
+    """Dispatches MDB events to handlers subscribed by command, on a pool of worker threads.
+
+    Commands in priority_commands (VEND REQUEST by default) get their own lane and workers, so a backlog of diagnostic
+    events can never delay an authorisation decision. Only handlers subscribed to a priority command by name run on
+    the priority lane. Handlers subscribed to everything get their copy of a priority event on the normal lane, so a
+    slow catch-all handler (like logging or telemetry) can't hold up an authorisation handler.
+
+    Ordering: every handler is pinned to one worker in each lane, so a handler sees the events of a lane in the order
+    they were published (e.g. VEND SUCCESS always before VEND SESSION COMPLETE). There is no ordering between lanes,
+    so a handler subscribed to both a priority and a normal command can see them out of order (e.g. a VEND CANCEL
+    before the VEND REQUEST it cancels). CashlessPeripheral.approve_vend refuses to approve a vend that's no longer
+    in progress for this reason.
+    """
+
+    def __init__(self, workers: int = 2, priority_workers: int = 1,
+                 priority_commands=DEFAULT_PRIORITY_COMMANDS):
+        self.workers = workers
+        self.priority_workers = priority_workers
+        self.priority_commands = frozenset(priority_commands)
+
+        self._lock = threading.Lock()  # only taken when (un)subscribing
+        # Copy on write, so the bus thread can check subscriptions without taking a lock. Maps each command to a tuple
+        # of handlers, with None as the key for handlers subscribed to everything.
+        self._handlers = {}
+        self._queues = [Queue() for _ in range(max(workers, 1))]
+        self._priority_queues = [Queue() for _ in range(max(priority_workers, 1))]
+        self._workers_by_handler = {}  # handler -> index of the worker it's pinned to, in each lane
+        self._next_worker = 0
+        self._threads = []
+
+    @property
+    def is_running(self) -> bool:
+        return bool(self._threads)
+
+    def start(self):
+        if self.is_running:
+            return
+        lanes = [(self._priority_queues, "priority"), (self._queues, "normal")]
+        for queues, lane in lanes:
+            for i, queue in enumerate(queues):
+                thread = threading.Thread(target=self._run, args=(queue,), name=f"pymultidropbus:dispatch:{lane}:{i}",
+                                          daemon=True)
+                thread.start()
+                self._threads.append((queue, thread))
+
+    def stop(self):
+        """Stops the workers once they've dispatched everything that's already been published."""
+        threads, self._threads = self._threads, []
+        for queue, _ in threads:
+            queue.put(_STOP)
+        for _, thread in threads:
+            if thread is not threading.current_thread():
+                thread.join()
+
+    def subscribe(self, commands, handler):
+        """Calls handler(event) for every event with one of the given commands. Pass None to subscribe to everything.
+
+        commands can be a single protocol.MdbCommand / Cashless.MdbCommand or an iterable of them.
+        """
+        with self._lock:
+            if handler not in self._workers_by_handler:
+                self._workers_by_handler[handler] = self._next_worker
+                self._next_worker += 1
+            handlers = dict(self._handlers)
+            for command in self._commands(commands):
+                handlers[command] = handlers.get(command, ()) + ((handler, self._workers_by_handler[handler]),)
+            self._handlers = handlers
+        return handler
+
+    def unsubscribe(self, commands, handler):
+        with self._lock:
+            handlers = dict(self._handlers)
+            for command in self._commands(commands):
+                remaining = tuple(h for h in handlers.get(command, ()) if h[0] != handler)
+                if remaining:
+                    handlers[command] = remaining
+                else:
+                    handlers.pop(command, None)
+            self._handlers = handlers
+            if not any(h[0] == handler for subscribed in handlers.values() for h in subscribed):
+                self._workers_by_handler.pop(handler, None)
+
+    def wants(self, command) -> bool:
+        # checked on the bus thread before an event is even created, so keep this cheap
+        handlers = self._handlers
+        return command in handlers or None in handlers
+
+    def publish(self, event: protocol.MdbCommandEvent):
+        handlers = self._handlers
+        subscribed = handlers.get(event.command, ())
+        if event.command in self.priority_commands:
+            for handler, worker in subscribed:
+                self._priority_queues[worker % len(self._priority_queues)].put((handler, event))
+            subscribed = ()
+        for handler, worker in subscribed + handlers.get(None, ()):
+            self._queues[worker % len(self._queues)].put((handler, event))
+
+    def backlog(self) -> int:
+        return sum(queue.qsize() for queue in self._queues)
+
+    def priority_backlog(self) -> int:
+        return sum(queue.qsize() for queue in self._priority_queues)
+
+    @staticmethod
+    def _commands(commands):
+        if commands is None or isinstance(commands, Enum):
+            return (commands,)
+        return tuple(commands)
+
+    @staticmethod
+    def _run(queue: Queue):
+        while True:
+            item = queue.get()
+            if item is _STOP:
+                return
+            handler, event = item
+            try:
+                handler(event)
+            except Exception:
+                logger.exception(f"Event handler {handler} failed for {event}")
@@ -0,0 +1,257 @@
+import json
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass, field
+from enum import Enum
+from queue import Empty, Queue
+
+logger = logging.getLogger("pymultidropbus:journal")
+
+
+class Durability(Enum):
+    # Records go through Python's file buffer, which is only written out when it fills up or the journal is closed.
+    # A process crash can lose the most recent records, so only use this when throughput matters more than recovery.
+    NONE = "none"
+    FLUSH = "flush"  # hand every group commit to the OS (survives a process crash, not a power cut)
+    FSYNC = "fsync"  # fsync every group commit (survives a power cut)
+
+
+class RecordType(str, Enum):
+    def __str__(self):
+        return str(self.value)
+
+    BEGIN_SESSION = "begin"
+    VEND_REQUEST = "vend_request"
+    APPROVE_VEND = "approve"
+    DENY_VEND = "deny"
+    VEND_SUCCESS = "success"
+    VEND_FAILURE = "failure"
+    VEND_CANCEL = "cancel"
+    SESSION_COMPLETE = "complete"
+    RECONCILED = "reconciled"
+
+
+@dataclass
+class UnfinishedVend:
+    session: int
+    vend: int
+    timestamp: float
+    item_price_cents: int
+    item_number: int or None
+    approved: bool = False
+    amount_charged_cents: int or None = None
+
+
+@dataclass
+class JournalRecovery:
+    unfinished_vends: list = field(default_factory=list)
+    session_open: bool = False
+    session_balance_cents: int or None = None
+    reader_state: str or None = None
+    last_session: int = 0
+    last_vend: int = 0
+
+
+_STOP = object()
+
+
+class _CommitWaiter:
+    # lets a caller wait for the group commit that contains its record
+    __slots__ = ("event", "ok")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.ok = False
+
+
+class SessionJournal:
+    """An append-only journal of cashless session lifecycle records.
+
+    Records are queued by the bus thread and written by a background thread in group commits, so journaling never adds
+    a disk write or flush to the POLL response path. Callers that mustn't go on until a record is durable (like
+    approving a vend) can pass wait=True to record(), which blocks until the record's group commit has finished.
+
+    The journal is never compacted or rotated, and the whole file is replayed every time it's opened. Rotate it (e.g.
+    move it aside while the peripheral is closed, after reconciling any unfinished vends) if it grows too large.
+    """
+
+    def __init__(self, path: str, durability: Durability = Durability.FSYNC, commit_interval: float = 0,
+                 max_batch: int = 256, wait_timeout: float = 5.0):
+        self.path = path
+        self.durability = durability
+        self.commit_interval = commit_interval  # optional minimum time between commits, to batch more records
+        self.max_batch = max_batch
+        self.wait_timeout = wait_timeout  # how long record(wait=True) waits for its commit
+        self.recovery: JournalRecovery or None = None
+        self.failed_commits = 0
+        self.last_error: OSError or None = None
+
+        self._queue = Queue()
+        self._file = None
+        self._writer_thread = None
+        self._session = 0
+        self._vend = 0
+
+    @property
+    def is_open(self) -> bool:
+        return self._writer_thread is not None
+
+    def open(self) -> JournalRecovery:
+        """Replays any existing journal and starts the writer thread."""
+        if self.is_open:
+            return self.recovery
+
+        self.recovery = self.replay(self.path)
+        self._session = self.recovery.last_session
+        self._vend = self.recovery.last_vend
+
+        self._file = open(self.path, "a", encoding="utf-8")
+        self._writer_thread = threading.Thread(target=self._run, name="pymultidropbus:journal", daemon=True)
+        self._writer_thread.start()
+        return self.recovery
+
+    def close(self):
+        """Commits everything that's been recorded so far and stops the writer thread."""
+        if not self.is_open:
+            return
+        self._queue.put(_STOP)
+        self._writer_thread.join()
+        self._writer_thread = None
+        self._file.close()
+        self._file = None
+
+    def record(self, record_type: RecordType, wait: bool = False, **fields) -> bool:
+        """Queues a record, returning False if it was dropped.
+
+        This is called from the bus thread, so by default it only builds the record and queues it. Serialisation and
+        disk I/O happen on the writer thread. With wait=True it also waits for the record's group commit, and returns
+        False if that failed or took longer than wait_timeout. With Durability.NONE there's nothing worth waiting
+        for, so wait is ignored.
+        """
+        if not self.is_open:
+            logger.warning(f"Session journal is closed, dropping {record_type.value} record")
+            return False
+
+        if record_type == RecordType.BEGIN_SESSION:
+            self._session += 1
+        elif record_type == RecordType.VEND_REQUEST:
+            self._vend += 1
+
+        record = {"ts": time.time(), "type": record_type.value, "session": self._session, "vend": self._vend}
+        record.update(fields)
+        if not wait or self.durability == Durability.NONE:
+            self._queue.put_nowait((record, None))
+            return True
+
+        waiter = _CommitWaiter()
+        self._queue.put_nowait((record, waiter))
+        if not waiter.event.wait(self.wait_timeout):
+            logger.error(f"The session journal didn't commit a {record_type.value} record within "
+                         f"{self.wait_timeout}s")
+            return False
+        return waiter.ok
+
+    def reconcile(self, vend: UnfinishedVend):
+        """Records that an unfinished vend from a previous run has been dealt with, so it isn't replayed again."""
+        if not self.is_open:
+            raise ValueError("The session journal must be open to reconcile a vend")
+        record = {"ts": time.time(), "type": RecordType.RECONCILED.value, "session": vend.session, "vend": vend.vend}
+        self._queue.put_nowait((record, None))
+        if self.recovery is not None and vend in self.recovery.unfinished_vends:
+            self.recovery.unfinished_vends.remove(vend)
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch = [self._queue.get()]
+            # group commit: grab everything that queued up while we were writing the last batch
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except Empty:
+                    break
+
+            if _STOP in batch:
+                stopping = True
+                batch = [record for record in batch if record is not _STOP]
+
+            if batch:
+                ok = self._commit([record for record, _ in batch])
+                for _, waiter in batch:
+                    if waiter is not None:
+                        waiter.ok = ok
+                        waiter.event.set()
+
+            if self.commit_interval and not stopping:
+                time.sleep(self.commit_interval)
+
+    def _commit(self, batch: list) -> bool:
+        try:
+            self._file.write("".join(json.dumps(record, separators=(",", ":")) + "\n" for record in batch))
+            if self.durability != Durability.NONE:
+                self._file.flush()
+            if self.durability == Durability.FSYNC:
+                os.fsync(self._file.fileno())
+        except OSError as e:
+            # callers waiting on these records are told it failed, everyone else can check failed_commits/last_error
+            logger.error(f"Failed to write {len(batch)} records to the session journal: {e}")
+            self.failed_commits += 1
+            self.last_error = e
+            return False
+        return True
+
+    @staticmethod
+    def replay(path: str) -> JournalRecovery:
+        """Reads a journal and works out which vends never finished."""
+        recovery = JournalRecovery()
+        if not os.path.exists(path):
+            return recovery
+
+        open_vends = {}
+        with open(path, "r", encoding="utf-8") as journal:
+            for line in journal:
+                try:
+                    record = json.loads(line)
+                    record_type = RecordType(record["type"])
+                except (ValueError, KeyError):
+                    # most likely a torn write from a crash, which can only be the last record
+                    logger.warning(f"Skipping unreadable session journal record: {line.strip()}")
+                    continue
+
+                key = (record.get("session"), record.get("vend"))
+                recovery.last_session = max(recovery.last_session, record.get("session") or 0)
+                recovery.last_vend = max(recovery.last_vend, record.get("vend") or 0)
+                if "state" in record:
+                    recovery.reader_state = record["state"]
+
+                if record_type == RecordType.BEGIN_SESSION:
+                    recovery.session_open = True
+                    recovery.session_balance_cents = record.get("balance")
+
+                elif record_type == RecordType.VEND_REQUEST:
+                    open_vends[key] = UnfinishedVend(record["session"], record["vend"], record["ts"],
+                                                     record.get("price"), record.get("item"))
+
+                elif record_type == RecordType.APPROVE_VEND:
+                    vend = open_vends.get(key)
+                    if vend is not None:
+                        vend.approved = True
+                        vend.amount_charged_cents = record.get("amount")
+
+                elif record_type in (RecordType.DENY_VEND, RecordType.VEND_SUCCESS, RecordType.VEND_FAILURE,
+                                     RecordType.VEND_CANCEL, RecordType.RECONCILED):
+                    open_vends.pop(key, None)
+
+                elif record_type == RecordType.SESSION_COMPLETE:
+                    recovery.session_open = False
+                    recovery.session_balance_cents = None
+                    # a vend that was never approved can't have charged anyone, but keep approved ones for
+                    # reconciliation because we never heard whether they succeeded
+                    for vend_key, vend in list(open_vends.items()):
+                        if vend.session == record.get("session") and not vend.approved:
+                            del open_vends[vend_key]
+
+        recovery.unfinished_vends = list(open_vends.values())
+        return recovery
@@ -0,0 +1,196 @@
+import http.server
+import logging
+import os
+import socketserver
+import stat
+import threading
+
+logger = logging.getLogger("pymultidropbus:metrics")
+
+OPENMETRICS_CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    formatted = ",".join(
+        '{}="{}"'.format(key, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for key, value in labels.items()
+    )
+    return "{" + formatted + "}"
+
+
+class Counter:
+    # Counters are updated without a lock to keep them cheap. "+=" isn't atomic, so a counter incremented from more
+    # than one thread at once can lose updates. The library only increments its counters from the incoming command
+    # thread; anything shared between threads should keep its own locked total and be given to the counter as a
+    # function, which is called when the registry is collected.
+    __slots__ = ("name", "labels", "value", "function")
+
+    def __init__(self, name: str, labels: dict = None, function=None):
+        self.name = name
+        self.labels = labels or {}
+        self.value = 0
+        self.function = function
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def get(self):
+        if self.function is not None:
+            return self.function()
+        return self.value
+
+
+class Gauge:
+    # Gauges can either be set directly, or be given a function that's called when the registry is collected. The
+    # function version costs nothing on the hot path, so use it for things like queue depths.
+    __slots__ = ("name", "labels", "value", "function")
+
+    def __init__(self, name: str, labels: dict = None, function=None):
+        self.name = name
+        self.labels = labels or {}
+        self.value = 0
+        self.function = function
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def get(self):
+        if self.function is not None:
+            return self.function()
+        return self.value
+
+
+class MetricsRegistry:
+    def __init__(self, prefix: str = "mdb"):
+        self.prefix = prefix
+        self._lock = threading.Lock()  # only taken when registering metrics, never when updating them
+        self._families = {}  # name -> (type, help, {labels key: metric})
+
+    def _register(self, metric_type: str, name: str, documentation: str, labels: dict, factory):
+        full_name = f"{self.prefix}_{name}" if self.prefix else name
+        label_key = tuple(sorted((labels or {}).items()))
+
+        with self._lock:
+            family = self._families.get(full_name)
+            if family is None:
+                family = (metric_type, documentation, {})
+                self._families[full_name] = family
+            elif family[0] != metric_type:
+                raise ValueError(f"Metric {full_name} is already registered as a {family[0]}")
+
+            # Registering the same metric twice is almost always two peripherals sharing a registry without distinct
+            # labels, and silently sharing the metric would report only one of them (function backed metrics are
+            # bound to whichever registered first), so refuse it.
+            if label_key in family[2]:
+                raise ValueError(f"Metric {full_name}{_format_labels(dict(label_key))} is already registered")
+            metric = factory(full_name)
+            family[2][label_key] = metric
+            return metric
+
+    def counter(self, name: str, documentation: str = "", labels: dict = None, function=None) -> Counter:
+        return self._register("counter", name, documentation, labels,
+                              lambda full_name: Counter(full_name, labels, function))
+
+    def gauge(self, name: str, documentation: str = "", labels: dict = None, function=None) -> Gauge:
+        return self._register("gauge", name, documentation, labels,
+                              lambda full_name: Gauge(full_name, labels, function))
+
+    def snapshot(self) -> dict:
+        """Returns the current value of every metric, keyed by its OpenMetrics sample name."""
+        values = {}
+        with self._lock:
+            families = [(name, family[0], list(family[2].values())) for name, family in self._families.items()]
+
+        for name, metric_type, metrics in families:
+            suffix = "_total" if metric_type == "counter" else ""
+            for metric in metrics:
+                value = metric.get()
+                values[name + suffix + _format_labels(metric.labels)] = value
+        return values
+
+    def to_openmetrics(self) -> str:
+        """Renders every metric in the OpenMetrics text format."""
+        lines = []
+        with self._lock:
+            families = [(name, family[0], family[1], list(family[2].values()))
+                        for name, family in self._families.items()]
+
+        for name, metric_type, documentation, metrics in families:
+            lines.append(f"# TYPE {name} {metric_type}")
+            if documentation:
+                lines.append(f"# HELP {name} {documentation}")
+            suffix = "_total" if metric_type == "counter" else ""
+            for metric in metrics:
+                value = metric.get()
+                lines.append(f"{name}{suffix}{_format_labels(metric.labels)} {value}")
+
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+
+class _MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    registry: MetricsRegistry = None
+
+    def do_GET(self):
+        body = self.registry.to_openmetrics().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", OPENMETRICS_CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        # unix socket clients don't have a (host, port) address
+        return str(self.client_address[0]) if self.client_address else "unix"
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class MetricsServer:
+    """Serves a MetricsRegistry over HTTP, either on a (host, port) tuple or a Unix socket path."""
+
+    def __init__(self, registry: MetricsRegistry, address=("127.0.0.1", 9464)):
+        self.registry = registry
+        self.address = address
+        self.server = None
+        self.thread = None
+
+    def start(self):
+        handler = type("MetricsRequestHandler", (_MetricsRequestHandler,), {"registry": self.registry})
+
+        if isinstance(self.address, str):
+            if os.path.exists(self.address):
+                if not stat.S_ISSOCK(os.stat(self.address).st_mode):
+                    raise FileExistsError(f"{self.address} already exists and isn't a socket")
+                os.unlink(self.address)  # clean up a stale socket from a previous run
+            self.server = _UnixHTTPServer(self.address, handler)
+        else:
+            self.server = http.server.ThreadingHTTPServer(self.address, handler)
+            self.server.daemon_threads = True
+
+        self.thread = threading.Thread(target=self.server.serve_forever, name="pymultidropbus:metrics", daemon=True)
+        self.thread.start()
+        logger.info(f"Serving metrics on {self.address}")
+
+    def stop(self):
+        if self.server is None:
+            return
+        self.server.shutdown()
+        self.server.server_close()
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.unlink(self.address)
+        self.server = None
+        self.thread = None
@@ -1,9 +1,13 @@
 from dataclasses import dataclass, field
 from enum import Enum
 
+from pymultidropbus import helpers
 import pymultidropbus.protocol as protocol
 import pymultidropbus.protocol.Vmc as Vmc
 
+MAX_USER_FILE_SIZE = 32  # data bytes in a USER FILE DATA response
+MAX_FTL_BLOCK_SIZE = 31  # data bytes in an FTL SEND BLOCK, which fills a 36 byte MDB frame
+
 
 class CashlessDeviceAddress(Enum):
     UNKNOWN = 0
@@ -20,6 +24,37 @@ class MdbResponse(Enum):
     def build(self, amount_charged: "protocol.Money") -> str:
         return self.value + amount_charged.vmc_hex
 
+    @protocol.BindCmdBuilder("USER_FILE_DATA")
+    def build(self, file_number: int, data: bytes) -> str:
+        if len(data) > MAX_USER_FILE_SIZE:
+            raise ValueError(f"User file {file_number} is {len(data)} bytes, the most is {MAX_USER_FILE_SIZE}")
+        return self.value + helpers.int_to_hex(file_number) + helpers.int_to_hex(len(data)) + bytes(data).hex()
+
+    @protocol.BindCmdBuilder("REQ_TO_RECV")
+    def build(self, destination: int, source: int, file_id: int, block_count: int, control: int = 0) -> str:
+        return (self.value + helpers.int_to_hex(destination) + helpers.int_to_hex(source) +
+                helpers.int_to_hex(file_id) + helpers.int_to_hex(block_count) + helpers.int_to_hex(control))
+
+    @protocol.BindCmdBuilder("RETRY_DENY")
+    def build(self, destination: int, source: int, retry_delay: int) -> str:
+        return (self.value + helpers.int_to_hex(destination) + helpers.int_to_hex(source) +
+                helpers.int_to_hex(retry_delay))
+
+    @protocol.BindCmdBuilder("SEND_BLOCK")
+    def build(self, destination: int, block_number: int, data: bytes) -> str:
+        if len(data) > MAX_FTL_BLOCK_SIZE:
+            raise ValueError(f"FTL block is {len(data)} bytes, the most is {MAX_FTL_BLOCK_SIZE}")
+        return self.value + helpers.int_to_hex(destination) + helpers.int_to_hex(block_number) + bytes(data).hex()
+
+    @protocol.BindCmdBuilder("OK_TO_SEND")
+    def build(self, destination: int, source: int) -> str:
+        return self.value + helpers.int_to_hex(destination) + helpers.int_to_hex(source)
+
+    @protocol.BindCmdBuilder("REQ_TO_SEND")
+    def build(self, destination: int, source: int, file_id: int, block_count: int, control: int = 0) -> str:
+        return (self.value + helpers.int_to_hex(destination) + helpers.int_to_hex(source) +
+                helpers.int_to_hex(file_id) + helpers.int_to_hex(block_count) + helpers.int_to_hex(control))
+
     # handle a default case (no arguments supported)
     @protocol.BindCmdBuilder()
     def build(self) -> str:
@@ -86,6 +121,11 @@ class MdbCommand(Enum):
     EXPANSION_REQ_TO_SEND = 25
     EXPANSION_DIAGNOSTICS = 26
 
+    # raised by the library when a whole FTL file has been received or sent, rather than for a command on the bus
+    FILE_RECEIVED = 27
+    FILE_SENT = 28
+    FILE_TRANSFER_FAILED = 29
+
 
 class AddressedMdbCommand:
     # MDB supports two cashless devices, labelled primary and secondary by the library
@@ -181,6 +221,11 @@ class SecondaryAddressMdbCommand(Enum):
     EXPANSION_DIAGNOSTICS = "67FF"
 
 
+class FileTransferDirection(Enum):
+    SEND = 0  # to the VMC
+    RECEIVE = 1  # from the VMC
+
+
 class State(Enum):
     INACTIVE = "CSH_INACTIVE"
     DISABLED = "CSH_DISABLED"
@@ -242,3 +287,47 @@ class VendSuccessCommandEvent(protocol.MdbCommandEvent):
     item_number: int
 
     command: MdbCommand = field(default=MdbCommand.VEND_SUCCESS, init=False)
+
+
+@dataclass
+class UserFileWriteCommandEvent(protocol.MdbCommandEvent):
+    file_number: int
+    data: bytes
+
+    command: MdbCommand = field(default=MdbCommand.EXPANSION_WRITE_USER_FILE, init=False)
+
+
+@dataclass
+class FileReceivedCommandEvent(protocol.MdbCommandEvent):
+    file_id: int
+    data: bytes
+    bytes_per_second: float
+
+    command: MdbCommand = field(default=MdbCommand.FILE_RECEIVED, init=False)
+
+
+@dataclass
+class FileSentCommandEvent(protocol.MdbCommandEvent):
+    file_id: int
+    size: int
+    bytes_per_second: float
+
+    command: MdbCommand = field(default=MdbCommand.FILE_SENT, init=False)
+
+
+@dataclass
+class FileTransferDeniedCommandEvent(protocol.MdbCommandEvent):
+    file_id: int
+    direction: FileTransferDirection
+    retry_delay: int
+
+    command: MdbCommand = field(default=MdbCommand.EXPANSION_RETRY_DENY, init=False)
+
+
+@dataclass
+class FileTransferFailedCommandEvent(protocol.MdbCommandEvent):
+    file_id: int
+    direction: FileTransferDirection
+    reason: str
+
+    command: MdbCommand = field(default=MdbCommand.FILE_TRANSFER_FAILED, init=False)
@@ -0,0 +1,140 @@
+import math
+import time
+
+import pymultidropbus.protocol.peripherals.Cashless as Cashless
+
+MAX_BLOCK_SIZE = Cashless.MAX_FTL_BLOCK_SIZE
+MAX_BLOCKS = 0xFF
+MAX_USER_FILE_SIZE = Cashless.MAX_USER_FILE_SIZE
+
+VMC_ADDRESS = 0x00
+CASHLESS_ADDRESSES = {
+    Cashless.CashlessDeviceAddress.PRIMARY: 0x10,
+    Cashless.CashlessDeviceAddress.SECONDARY: 0x60,
+}
+
+
+class _Transfer:
+    def __init__(self, file_id: int, destination: int, source: int):
+        self.file_id = file_id
+        self.destination = destination
+        self.source = source
+        self.started_at = None
+        self.completed_at = None
+        self.last_activity = time.monotonic()  # when the transfer was created or last made progress
+
+    def start(self):
+        self.started_at = self.last_activity = time.monotonic()
+
+    def idle_seconds(self) -> float:
+        return time.monotonic() - self.last_activity
+
+    @property
+    def size(self) -> int:
+        raise NotImplementedError("You must implement this property in a subclass")
+
+    @property
+    def complete(self) -> bool:
+        return self.completed_at is not None
+
+    @property
+    def bytes_per_second(self) -> float:
+        if self.started_at is None:
+            return 0.0
+        elapsed = (self.completed_at or time.monotonic()) - self.started_at
+        return self.size / elapsed if elapsed > 0 else 0.0
+
+
+class OutgoingTransfer(_Transfer):
+    """A file being sent to the VMC in maximal size blocks, one block per POLL."""
+
+    def __init__(self, file_id: int, payload: bytes, destination: int = VMC_ADDRESS,
+                 source: int = CASHLESS_ADDRESSES[Cashless.CashlessDeviceAddress.PRIMARY]):
+        super().__init__(file_id, destination, source)
+        if not payload:
+            raise ValueError("Can't send an empty file")
+        self.payload = memoryview(bytes(payload))
+        self.block_count = math.ceil(len(self.payload) / MAX_BLOCK_SIZE)
+        if self.block_count > MAX_BLOCKS:
+            raise ValueError(f"File is {len(self.payload)} bytes, the most that can be sent is "
+                             f"{MAX_BLOCKS * MAX_BLOCK_SIZE} bytes")
+        self.next_block_number = 0
+        self.bytes_sent = 0
+
+    @property
+    def size(self) -> int:
+        return len(self.payload)
+
+    def next_block(self) -> "tuple[str, int] or None":
+        """Builds the SEND BLOCK response for the next block, returning it and how many data bytes it carries."""
+        if self.next_block_number >= self.block_count:
+            return None
+        offset = self.next_block_number * MAX_BLOCK_SIZE
+        data = self.payload[offset:offset + MAX_BLOCK_SIZE]
+        command = Cashless.MdbResponse.SEND_BLOCK.build(self.destination, self.next_block_number, data)
+        self.next_block_number += 1
+        return command, len(data)
+
+    def mark_sent(self, size: int):
+        self.bytes_sent += size
+        self.last_activity = time.monotonic()
+        if self.bytes_sent >= self.size:
+            self.completed_at = time.monotonic()
+
+
+class IncomingTransfer(_Transfer):
+    """A file being received from the VMC, reassembled in place into a buffer allocated up front.
+
+    When we ask for a file with REQ TO RCV, block_count is only the most we'll accept and size_known is False until the
+    VMC announces the real count with REQ TO SEND. If it sends the blocks straight away instead, the first short block
+    is taken to be the last one.
+    """
+
+    def __init__(self, file_id: int, block_count: int, destination: int, source: int = VMC_ADDRESS,
+                 size_known: bool = True):
+        super().__init__(file_id, destination, source)
+        if not 0 < block_count <= MAX_BLOCKS:
+            raise ValueError(f"A file must have between 1 and {MAX_BLOCKS} blocks, not {block_count}")
+        self.block_count = block_count
+        self.size_known = size_known
+        self.buffer = bytearray(block_count * MAX_BLOCK_SIZE)
+        self.received_blocks = bytearray(block_count)  # 1 for each block we've got
+        self.received_count = 0
+        self.length = 0
+
+    @property
+    def size(self) -> int:
+        return self.length
+
+    def add_block(self, block_number: int, data: bytes):
+        if block_number >= self.block_count or len(data) > MAX_BLOCK_SIZE:
+            raise ValueError(f"Block {block_number} ({len(data)} bytes) is outside a {self.block_count} block file")
+        if self.started_at is None:
+            self.start()
+        self.last_activity = time.monotonic()
+
+        offset = block_number * MAX_BLOCK_SIZE
+        self.buffer[offset:offset + len(data)] = data
+        self.length = max(self.length, offset + len(data))
+        if not self.received_blocks[block_number]:
+            self.received_blocks[block_number] = 1
+            self.received_count += 1
+        if not self.size_known and len(data) < MAX_BLOCK_SIZE:
+            self.set_block_count(block_number + 1)
+        if self.received_count == self.block_count:
+            self.completed_at = time.monotonic()
+
+    def set_block_count(self, block_count: int):
+        """Sets the real size of a file whose size wasn't known, which can't be more than we asked for."""
+        if not 0 < block_count <= self.block_count:
+            raise ValueError(f"A {block_count} block file is larger than the {self.block_count} blocks we asked for")
+        self.size_known = True
+        self.block_count = block_count
+        del self.buffer[block_count * MAX_BLOCK_SIZE:]
+        del self.received_blocks[block_count:]
+        self.received_count = sum(self.received_blocks)
+        self.length = min(self.length, len(self.buffer))
+
+    @property
+    def data(self) -> bytes:
+        return bytes(memoryview(self.buffer)[:self.length])
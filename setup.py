@@ -9,4 +9,7 @@ setup(
     install_requires=[
         "pyserial",
     ],
+    extras_require={
+        "analytics": ["numpy"],
+    },
 )
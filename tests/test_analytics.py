@@ -0,0 +1,135 @@
+import math
+from collections import Counter
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+import pymultidropbus.protocol as protocol  # noqa: E402
+import pymultidropbus.protocol.peripherals.Cashless as Cashless  # noqa: E402
+from pymultidropbus import analytics  # noqa: E402
+
+
+def frames(*lines):
+    return analytics.parse_frames(lines)
+
+
+def test_decode_vend_request_and_approval():
+    decoded = frames("1.0 > 1300012C0005", "1.001 < 05012C")
+    request, approval = decoded
+    assert request["direction"] == analytics.VMC_TO_PERIPHERAL
+    assert request["command"] == Cashless.MdbCommand.VEND_REQUEST.value
+    assert request["device"] == Cashless.CashlessDeviceAddress.PRIMARY.value
+    assert (request["price"], request["item"], request["length"]) == (300, 5, 6)
+    assert approval["direction"] == analytics.PERIPHERAL_TO_VMC
+    assert (approval["command"], approval["response"], approval["price"]) == (-1, 0x05, 300)
+    assert approval["item"] == protocol.UNKNOWN_ITEM_NUMBER
+
+
+def test_decode_commands_without_sub_command():
+    poll, reset, secondary_poll = frames("1.0 > 12", "2.0 > 10", "3.0 > 62")
+    assert poll["command"] == Cashless.MdbCommand.POLL.value
+    assert reset["command"] == Cashless.MdbCommand.RESET.value
+    assert secondary_poll["command"] == Cashless.MdbCommand.POLL.value
+    assert secondary_poll["device"] == Cashless.CashlessDeviceAddress.SECONDARY.value
+
+
+def test_cash_sale_isnt_session_complete():
+    complete, cash_sale = frames("1.0 > 1304", "2.0 > 1305012C0005")
+    assert complete["command"] == Cashless.MdbCommand.VEND_SESSION_COMPLETE.value
+    assert cash_sale["command"] == analytics.VEND_CASH_SALE
+
+    analyzer = analytics.CaptureAnalyzer()
+    analyzer.update(frames("1.0 < 03FFFF", "2.0 > 1305012C0005", "3.0 > 1304"))
+    assert analyzer.vend_outcome_counts()["VEND_CASH_SALE"] == 1
+    assert analyzer.session_durations.count == 1
+    assert analyzer.session_durations.total == pytest.approx(2.0)
+
+
+@pytest.mark.parametrize("line, reason", [
+    ("1.0 > 12 extra", "malformed"),
+    ("1.0 ? 12", "malformed"),
+    ("one > 12", "malformed"),
+    ("1.0 > 1G", "malformed"),
+    ("1.0 > 123", "malformed"),
+    ("1.0 > " + "00" * (analytics.MAX_FRAME_BYTES + 1), "oversized"),
+])
+def test_split_line_skip_reasons(line, reason):
+    assert analytics._split_line(line) == reason
+
+
+def test_parse_frames_counts_skipped_lines():
+    skipped = Counter()
+    parsed = analytics.parse_frames(["# comment", "", "1.0 > 12", "1.1 < 00", "1.2 > 1", "1.3 > " + "00" * 40],
+                                    skipped)
+    assert len(parsed) == 2
+    assert skipped == Counter(malformed=1, oversized=1)
+
+
+def test_pair_intervals():
+    timestamps = np.array([0.0, 1.0, 2.0, 4.0, 5.0, 7.0])
+    is_start = np.array([True, True, False, False, True, False])
+    is_end = np.array([False, False, True, True, False, True])
+    intervals, carry = analytics.pair_intervals(timestamps, is_start, is_end)
+    # the second end has no start since the first end, and the first start is replaced by the second
+    assert intervals.tolist() == [1.0, 2.0]
+    assert math.isnan(carry)
+
+
+@pytest.mark.parametrize("split", range(1, 8))
+def test_pair_intervals_across_chunks(split):
+    timestamps = np.arange(8, dtype=np.float64)
+    is_start = np.array([True, False, False, True, False, True, True, False])
+    is_end = np.array([False, True, False, False, True, False, False, True])
+    whole, whole_carry = analytics.pair_intervals(timestamps, is_start, is_end)
+
+    first, carry = analytics.pair_intervals(timestamps[:split], is_start[:split], is_end[:split])
+    second, carry = analytics.pair_intervals(timestamps[split:], is_start[split:], is_end[split:], carry)
+    assert np.concatenate((first, second)).tolist() == whole.tolist()
+    assert math.isnan(carry) and math.isnan(whole_carry)
+
+
+def test_pair_intervals_cancel():
+    timestamps = np.array([0.0, 1.0, 2.0, 3.0, 4.0])
+    is_start = np.array([True, False, False, True, False])
+    is_end = np.array([False, False, True, False, True])
+    is_cancel = np.array([False, True, False, False, False])
+    intervals, _ = analytics.pair_intervals(timestamps, is_start, is_end, is_cancel=is_cancel)
+    assert intervals.tolist() == [1.0]
+
+    # a cancel at the end of a chunk means there's nothing to carry
+    _, carry = analytics.pair_intervals(timestamps[:2], is_start[:2], is_end[:2], is_cancel=is_cancel[:2])
+    assert math.isnan(carry)
+
+
+def test_unanswered_poll_isnt_paired_with_a_later_response():
+    analyzer = analytics.CaptureAnalyzer()
+    analyzer.update(frames("1.000 > 12", "1.100 > 1300012C0005", "1.101 < 00", "2.000 > 12", "2.001 < 00"))
+    assert analyzer.poll_count == 2
+    assert analyzer.poll_response_latencies.count == 1
+    assert analyzer.poll_response_latencies.maximum == pytest.approx(0.001)
+    assert analyzer.unanswered_polls == 1
+
+
+def test_analyse_capture_in_chunks(tmp_path):
+    capture = tmp_path / "capture.log"
+    capture.write_text("\n".join([
+        "1.000 > 12", "1.001 < 03FFFF",
+        "1.100 > 1300012C0005", "1.150 < 05012C",
+        "2.000 > 13020005",
+        "2.100 > 12", "2.101 < 00",
+        "3.000 > 1304",
+        "3.5 > 1",  # torn last line
+    ]))
+    whole = analytics.analyse_capture(str(capture))
+    for chunk_size in (1, 2, 3):
+        chunked = analytics.analyse_capture(str(capture), chunk_size=chunk_size)
+        assert chunked.command_counts.tolist() == whole.command_counts.tolist()
+        assert chunked.session_durations.total == pytest.approx(whole.session_durations.total)
+        assert chunked.approval_latencies.total == pytest.approx(whole.approval_latencies.total)
+        assert chunked.poll_response_latencies.count == whole.poll_response_latencies.count
+
+    assert whole.skipped_lines == Counter(malformed=1)
+    assert whole.session_durations.total == pytest.approx(1.999)
+    assert whole.approval_latencies.total == pytest.approx(0.05)
+    assert whole.poll_response_latencies.count == 2
@@ -0,0 +1,121 @@
+import json
+
+import pytest
+
+from pymultidropbus.journal import Durability, RecordType, SessionJournal
+
+
+def write_journal(path, *records, torn_tail: str = None):
+    with open(path, "w", encoding="utf-8") as journal:
+        for ts, (record_type, session, vend, fields) in enumerate(records):
+            record = {"ts": ts, "type": record_type.value, "session": session, "vend": vend}
+            record.update(fields)
+            journal.write(json.dumps(record) + "\n")
+        if torn_tail is not None:
+            journal.write(torn_tail)
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "sessions.journal")
+
+
+def test_missing_journal(path):
+    recovery = SessionJournal.replay(path)
+    assert recovery.unfinished_vends == []
+    assert not recovery.session_open
+
+
+def test_approved_vend_without_outcome(path):
+    write_journal(path,
+                  (RecordType.BEGIN_SESSION, 1, 0, {"balance": 500}),
+                  (RecordType.VEND_REQUEST, 1, 1, {"price": 300, "item": 5}),
+                  (RecordType.APPROVE_VEND, 1, 1, {"amount": 300}))
+    recovery = SessionJournal.replay(path)
+    assert recovery.session_open
+    assert recovery.session_balance_cents == 500
+    [vend] = recovery.unfinished_vends
+    assert (vend.session, vend.vend, vend.item_price_cents, vend.item_number) == (1, 1, 300, 5)
+    assert vend.approved
+    assert vend.amount_charged_cents == 300
+
+
+def test_approved_vend_survives_session_complete(path):
+    write_journal(path,
+                  (RecordType.BEGIN_SESSION, 1, 0, {}),
+                  (RecordType.VEND_REQUEST, 1, 1, {"price": 300}),
+                  (RecordType.APPROVE_VEND, 1, 1, {"amount": 300}),
+                  (RecordType.SESSION_COMPLETE, 1, 1, {}))
+    recovery = SessionJournal.replay(path)
+    assert not recovery.session_open
+    assert [vend.approved for vend in recovery.unfinished_vends] == [True]
+
+
+def test_unapproved_vend_closed_by_session_complete(path):
+    write_journal(path,
+                  (RecordType.BEGIN_SESSION, 1, 0, {}),
+                  (RecordType.VEND_REQUEST, 1, 1, {"price": 300}),
+                  (RecordType.SESSION_COMPLETE, 1, 1, {}))
+    recovery = SessionJournal.replay(path)
+    assert recovery.unfinished_vends == []
+    assert not recovery.session_open
+    assert (recovery.last_session, recovery.last_vend) == (1, 1)
+
+
+@pytest.mark.parametrize("outcome", [RecordType.VEND_SUCCESS, RecordType.VEND_FAILURE, RecordType.VEND_CANCEL,
+                                     RecordType.DENY_VEND, RecordType.RECONCILED])
+def test_finished_vends(path, outcome):
+    write_journal(path,
+                  (RecordType.BEGIN_SESSION, 1, 0, {}),
+                  (RecordType.VEND_REQUEST, 1, 1, {"price": 300}),
+                  (RecordType.APPROVE_VEND, 1, 1, {"amount": 300}),
+                  (outcome, 1, 1, {}))
+    assert SessionJournal.replay(path).unfinished_vends == []
+
+
+def test_torn_last_line(path):
+    write_journal(path,
+                  (RecordType.BEGIN_SESSION, 1, 0, {}),
+                  (RecordType.VEND_REQUEST, 1, 1, {"price": 300}),
+                  (RecordType.APPROVE_VEND, 1, 1, {"amount": 300}),
+                  torn_tail='{"ts": 4, "type": "succ')
+    [vend] = SessionJournal.replay(path).unfinished_vends
+    assert vend.approved
+
+
+def test_reconcile_is_replayed(path):
+    write_journal(path,
+                  (RecordType.VEND_REQUEST, 1, 1, {"price": 300}),
+                  (RecordType.APPROVE_VEND, 1, 1, {"amount": 300}))
+    journal = SessionJournal(path, Durability.FLUSH)
+    [vend] = journal.open().unfinished_vends
+    journal.reconcile(vend)
+    journal.close()
+    assert SessionJournal.replay(path).unfinished_vends == []
+
+
+def test_record_waits_for_commit(path):
+    journal = SessionJournal(path, Durability.FLUSH)
+    journal.open()
+    assert journal.record(RecordType.BEGIN_SESSION, wait=True, balance=500)
+    assert SessionJournal.replay(path).session_open
+    journal.close()
+    assert not journal.record(RecordType.SESSION_COMPLETE)
+
+
+def test_failed_commit_is_reported(path):
+    class BrokenFile:
+        def write(self, data):
+            raise OSError("disk full")
+
+        def close(self):
+            pass
+
+    journal = SessionJournal(path, Durability.FSYNC)
+    journal.open()
+    journal._file.close()
+    journal._file = BrokenFile()
+    assert not journal.record(RecordType.BEGIN_SESSION, wait=True)
+    assert journal.failed_commits == 1
+    assert isinstance(journal.last_error, OSError)
+    journal.close()
@@ -0,0 +1,97 @@
+import random
+
+import pytest
+
+import pymultidropbus.protocol.peripherals.Cashless as Cashless
+from pymultidropbus import transfer
+
+MAX_FRAME_SIZE = 36  # data bytes in an MDB frame, without the checksum
+
+
+def send_blocks(outgoing: transfer.OutgoingTransfer) -> list:
+    """Returns (block number, data) for every SEND BLOCK response of a transfer, parsed back from the frame hex."""
+    blocks = []
+    while True:
+        block = outgoing.next_block()
+        if block is None:
+            return blocks
+        command, size = block
+        frame = bytes.fromhex(command)
+        assert frame[0] == int(Cashless.MdbResponse.SEND_BLOCK.value, 16)
+        assert len(frame) <= MAX_FRAME_SIZE
+        assert len(frame[3:]) == size
+        blocks.append((frame[2], frame[3:]))
+        outgoing.mark_sent(size)
+
+
+@pytest.mark.parametrize("size", [1, 30, 31, 32, 62, 100, transfer.MAX_BLOCKS * transfer.MAX_BLOCK_SIZE])
+def test_round_trip(size):
+    payload = bytes(random.Random(size).getrandbits(8) for _ in range(size))
+    outgoing = transfer.OutgoingTransfer(1, payload)
+    blocks = send_blocks(outgoing)
+    assert outgoing.complete
+    assert len(blocks) == outgoing.block_count
+
+    incoming = transfer.IncomingTransfer(1, outgoing.block_count, destination=0x10)
+    for block_number, data in blocks:
+        incoming.add_block(block_number, data)
+    assert incoming.complete
+    assert incoming.data == payload
+
+
+def test_out_of_order_and_repeated_blocks():
+    payload = bytes(range(200))
+    blocks = send_blocks(transfer.OutgoingTransfer(1, payload))
+    shuffled = blocks + blocks[:2]
+    random.Random(0).shuffle(shuffled)
+
+    incoming = transfer.IncomingTransfer(1, len(blocks), destination=0x10)
+    for block_number, data in shuffled:
+        incoming.add_block(block_number, data)
+    assert incoming.complete
+    assert incoming.data == payload
+
+
+def test_requested_file_ends_at_short_block():
+    payload = bytes(range(40))
+    incoming = transfer.IncomingTransfer(1, transfer.MAX_BLOCKS, destination=0x10, size_known=False)
+    for block_number, data in send_blocks(transfer.OutgoingTransfer(1, payload)):
+        incoming.add_block(block_number, data)
+    assert incoming.complete
+    assert incoming.block_count == 2
+    assert incoming.data == payload
+
+
+def test_requested_file_announced_size():
+    incoming = transfer.IncomingTransfer(1, 4, destination=0x10, size_known=False)
+    with pytest.raises(ValueError):
+        incoming.set_block_count(5)
+    incoming.set_block_count(2)
+    incoming.add_block(0, bytes(31))
+    assert not incoming.complete
+    incoming.add_block(1, bytes(31))
+    assert incoming.complete
+    assert incoming.size == 62
+
+
+def test_block_outside_file():
+    incoming = transfer.IncomingTransfer(1, 2, destination=0x10)
+    with pytest.raises(ValueError):
+        incoming.add_block(2, b"\x00")
+    with pytest.raises(ValueError):
+        incoming.add_block(0, bytes(transfer.MAX_BLOCK_SIZE + 1))
+
+
+def test_file_too_large():
+    with pytest.raises(ValueError):
+        transfer.OutgoingTransfer(1, bytes(transfer.MAX_BLOCKS * transfer.MAX_BLOCK_SIZE + 1))
+    with pytest.raises(ValueError):
+        transfer.OutgoingTransfer(1, b"")
+
+
+def test_user_file_data_size():
+    frame = bytes.fromhex(Cashless.MdbResponse.USER_FILE_DATA.build(1, bytes(transfer.MAX_USER_FILE_SIZE)))
+    assert len(frame) <= MAX_FRAME_SIZE
+    assert frame[2] == transfer.MAX_USER_FILE_SIZE
+    with pytest.raises(ValueError):
+        Cashless.MdbResponse.USER_FILE_DATA.build(1, bytes(transfer.MAX_USER_FILE_SIZE + 1))